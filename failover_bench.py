@@ -0,0 +1,377 @@
+#!/usr/bin/env python
+
+# Failover benchmark and chaos harness.
+#
+# Starts N local Postgres instances, each under its own governor.py, against an in-process fake
+# of the etcd v2 keys API. Keeps writing to the leader while it injects a fault, then measures
+# how long the cluster took to elect and promote a new leader, how long writes were refused and
+# how much acknowledged WAL was lost. Results go to a JSON report that can be compared with a
+# previous one as a regression baseline.
+#
+#   ./failover_bench.py --members 3 --runs 5 --fault kill_leader --report report.json
+#   ./failover_bench.py --fault partition_leader --baseline report.json
+
+import sys, os, yaml, time, json, random, signal, shutil, subprocess, threading, argparse, platform
+import logging
+import psycopg2
+
+from helpers.fake_etcd import FakeEtcd
+from helpers.postgresql import wal_names
+
+logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s', level=logging.INFO)
+logger = logging.getLogger("failover_bench")
+
+FAULTS = ["kill_leader", "pause_etcd", "etcd_latency", "partition_leader"]
+
+class Member:
+    def __init__(self, index, template, options, listener):
+        self.name = "postgresql%d" % index
+        self.port = options.base_port + index
+        self.config_path = os.path.join(options.workdir, "%s.yml" % self.name)
+        self.listener = listener
+        self.process = None
+
+        config = yaml.load(open(template).read())
+        config["loop_wait"] = options.loop_wait
+        config["etcd"]["scope"] = options.scope
+        config["etcd"]["ttl"] = options.ttl
+        config["etcd"]["endpoint"] = listener.url()
+        config["etcd"]["api"] = options.api
+        config["haproxy_status"] = {"listen": "127.0.0.1:%d" % (options.base_port + 10000 + index)}
+        config["postgresql"]["name"] = self.name
+        config["postgresql"]["listen"] = "127.0.0.1:%d" % self.port
+        config["postgresql"]["data_dir"] = os.path.join(options.workdir, self.name)
+        config["postgresql"]["parameters"]["archive_mode"] = "off"
+        config["postgresql"]["parameters"].pop("archive_command", None)
+        config["postgresql"]["parameters"]["synchronous_standby_names"] = ""
+        self.data_dir = config["postgresql"]["data_dir"]
+
+        f = open(self.config_path, "w")
+        f.write(yaml.dump(config, default_flow_style=False))
+        f.close()
+
+    def start(self, workdir):
+        log = open(os.path.join(workdir, "%s.log" % self.name), "a")
+        self.process = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "governor.py"), self.config_path],
+                                        stdout=log, stderr=subprocess.STDOUT, preexec_fn=os.setsid)
+
+    def postmaster_pid(self):
+        try:
+            return int(open(os.path.join(self.data_dir, "postmaster.pid")).readline().strip())
+        except (IOError, ValueError):
+            return None
+
+    # what a host failure looks like: the governor and postgres vanish without cleaning up
+    def kill(self):
+        pid = self.postmaster_pid()
+        if self.process is not None:
+            os.killpg(self.process.pid, signal.SIGKILL)
+            self.process.wait()
+            self.process = None
+        if pid is not None:
+            try:
+                os.killpg(pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+    def stop(self):
+        if self.process is not None:
+            os.killpg(self.process.pid, signal.SIGTERM)
+            self.process.wait()
+            self.process = None
+
+    def connect(self):
+        conn = psycopg2.connect(host="127.0.0.1", port=self.port, dbname="postgres", connect_timeout=1)
+        conn.autocommit = True
+        return conn
+
+    def is_writable(self):
+        try:
+            conn = self.connect()
+            cursor = conn.cursor()
+            cursor.execute("SELECT pg_is_in_recovery();")
+            writable = not cursor.fetchone()[0]
+            conn.close()
+            return writable
+        except psycopg2.Error:
+            return False
+
+class Writer(threading.Thread):
+    def __init__(self, cluster, interval):
+        threading.Thread.__init__(self, name="writer")
+        self.daemon = True
+        self.cluster = cluster
+        self.interval = interval
+        self.next_id = 1
+        # (acknowledged at, id, WAL position, member that acknowledged it)
+        self.acked = []
+        self.stopped = False
+        self.conn = None
+        self.target = None
+
+    def run(self):
+        while not self.stopped:
+            try:
+                if self.conn is None:
+                    leader = self.cluster.leader()
+                    if leader is None:
+                        raise psycopg2.OperationalError("no leader")
+                    self.conn = leader.connect()
+                    self.target = leader.name
+                cursor = self.conn.cursor()
+                cursor.execute(wal_names("INSERT INTO governor_bench (id) VALUES (%s) RETURNING pg_current_xlog_location() - '0/0'::pg_lsn;", self.conn.server_version), (self.next_id,))
+                self.acked.append((time.time(), self.next_id, int(cursor.fetchone()[0]), self.target))
+                self.next_id += 1
+            except psycopg2.Error:
+                if self.conn is not None:
+                    try:
+                        self.conn.close()
+                    except psycopg2.Error:
+                        pass
+                self.conn = None
+            time.sleep(self.interval)
+
+class Cluster:
+    def __init__(self, options):
+        self.options = options
+        self.etcd = FakeEtcd()
+        self.members = [Member(i, options.template, options, self.etcd.listener("postgresql%d" % i)) for i in range(options.members)]
+
+    def leader_name(self):
+        return self.etcd.value("/service/%s/leader" % self.options.scope)
+
+    def leader(self):
+        name = self.leader_name()
+        for member in self.members:
+            if member.name == name:
+                return member
+        return None
+
+    def start(self):
+        for member in self.members:
+            member.start(self.options.workdir)
+            # the first member wins the initialize race; give it a head start
+            if member is self.members[0]:
+                self.wait_for(lambda: self.leader() is not None and self.leader().is_writable(), 120, "initial leader")
+
+    def wait_for(self, condition, timeout, what):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if condition():
+                return True
+            time.sleep(0.1)
+        raise RuntimeError("timed out after %ss waiting for %s" % (timeout, what))
+
+    def wait_healthy(self):
+        def streaming():
+            leader = self.leader()
+            if leader is None or not leader.is_writable():
+                return False
+            try:
+                conn = leader.connect()
+                cursor = conn.cursor()
+                cursor.execute("SELECT count(*) FROM pg_stat_replication WHERE state = 'streaming';")
+                count = cursor.fetchone()[0]
+                conn.close()
+            except psycopg2.Error:
+                return False
+            return count == len(self.members) - 1
+        self.wait_for(streaming, 300, "all replicas streaming")
+
+    def stop(self):
+        for member in self.members:
+            member.stop()
+        self.etcd.shutdown()
+
+def inject(cluster, fault, duration):
+    old_leader = cluster.leader()
+    logger.info("Injecting %s on %s" % (fault, old_leader.name))
+    if fault == "kill_leader":
+        old_leader.kill()
+        return old_leader, lambda: old_leader.start(cluster.options.workdir)
+    if fault == "pause_etcd":
+        cluster.etcd.paused = True
+        time.sleep(duration)
+        cluster.etcd.paused = False
+        return old_leader, lambda: None
+    if fault == "etcd_latency":
+        cluster.etcd.latency = cluster.options.latency
+        time.sleep(duration)
+        cluster.etcd.latency = 0
+        return old_leader, lambda: None
+    if fault == "partition_leader":
+        old_leader.listener.partitioned = True
+        def heal():
+            old_leader.listener.partitioned = False
+        return old_leader, heal
+    raise ValueError("unknown fault %s" % fault)
+
+def measure(cluster, writer, fault, duration):
+    old_leader = cluster.leader()
+    injected_at = time.time()
+    old_leader, heal = inject(cluster, fault, duration)
+
+    new_leader_at = None
+    deadline = injected_at + cluster.options.ttl * 4 + 60
+    while time.time() < deadline:
+        leader = cluster.leader()
+        if leader is not None and leader is not old_leader and leader.is_writable():
+            new_leader_at = time.time()
+            break
+        # faults that do not cost the leader its lock are over once writes flow again
+        if fault in ("pause_etcd", "etcd_latency") and writer.acked and writer.acked[-1][0] > injected_at + duration:
+            break
+        time.sleep(0.05)
+    time.sleep(2)
+
+    # everything acknowledged until the fault is healed counts, including what a partitioned old
+    # primary kept acknowledging after it: that is what a split brain loses
+    acked = list(writer.acked)
+    heal()
+    before = [ack for ack in acked if ack[0] <= injected_at]
+    after = [ack for ack in acked if ack[0] > injected_at]
+    last_before = before and before[-1] or None
+    new_leader = cluster.leader()
+
+    result = {
+        "fault": fault,
+        "old_leader": old_leader.name,
+        "new_leader": cluster.leader_name(),
+        "time_to_new_leader": new_leader_at and round(new_leader_at - injected_at, 3),
+        "write_unavailability": write_unavailability(last_before, after, old_leader, new_leader),
+        "lost_rows": 0,
+        "data_loss_bytes": 0,
+    }
+
+    # acknowledged rows the surviving leader does not have
+    if new_leader is not None and acked:
+        conn = new_leader.connect()
+        cursor = conn.cursor()
+        cursor.execute("SELECT id FROM governor_bench WHERE id <= %s;", (acked[-1][1],))
+        present = set([row[0] for row in cursor.fetchall()])
+        conn.close()
+        lost = [ack for ack in acked if ack[1] not in present]
+        if lost:
+            result["lost_rows"] = len(lost)
+            # WAL positions only compare within the history of the primary that acknowledged them
+            lost_old = [ack for ack in lost if ack[3] == old_leader.name]
+            kept_old = [ack for ack in acked if ack[3] == old_leader.name and ack[1] in present]
+            if lost_old:
+                result["data_loss_bytes"] = max(0, lost_old[-1][2] - (kept_old and kept_old[-1][2] or lost_old[0][2]))
+    return result
+
+# with a new leader, from the last write before the fault to the first one the new leader
+# acknowledged; when the leader stayed, the longest gap between acknowledged writes
+def write_unavailability(last_before, after, old_leader, new_leader):
+    if last_before is None:
+        return None
+    if new_leader is not None and new_leader is not old_leader:
+        served = [ack for ack in after if ack[3] == new_leader.name]
+        return served and round(served[0][0] - last_before[0], 3) or None
+    times = [last_before[0]] + [ack[0] for ack in after]
+    if len(times) < 2:
+        return None
+    return round(max([b - a for a, b in zip(times, times[1:])]), 3)
+
+def percentile(values, fraction):
+    values = sorted([v for v in values if v is not None])
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+def summarise(results):
+    summary = {}
+    for metric in ("time_to_new_leader", "write_unavailability", "lost_rows", "data_loss_bytes"):
+        values = [r[metric] for r in results]
+        summary[metric] = {"median": percentile(values, 0.5), "p95": percentile(values, 0.95), "max": percentile(values, 1.0)}
+    return summary
+
+# a metric regresses when its median is worse than the baseline's by more than the tolerance
+def compare(summary, baseline, tolerance):
+    regressions = []
+    for metric, values in summary.items():
+        old = baseline.get("summary", {}).get(metric, {}).get("median")
+        new = values["median"]
+        if old is None or new is None:
+            continue
+        if new > old * (1 + tolerance) and new - old > 0.5:
+            regressions.append("%s: median %s, baseline %s" % (metric, new, old))
+    return regressions
+
+def git_revision():
+    try:
+        return subprocess.Popen(["git", "rev-parse", "HEAD"], stdout=subprocess.PIPE, cwd=os.path.dirname(os.path.abspath(__file__))).communicate()[0].strip()
+    except OSError:
+        return None
+
+def run(options):
+    random.seed(options.seed)
+    if os.path.exists(options.workdir):
+        shutil.rmtree(options.workdir)
+    os.makedirs(options.workdir)
+
+    cluster = Cluster(options)
+    results = []
+    try:
+        cluster.start()
+        cluster.wait_healthy()
+        conn = cluster.leader().connect()
+        conn.cursor().execute("CREATE TABLE governor_bench (id bigint PRIMARY KEY);")
+        conn.close()
+
+        writer = Writer(cluster, options.write_interval)
+        writer.start()
+        for run_number in range(options.runs):
+            fault = options.fault or random.choice(FAULTS)
+            cluster.wait_healthy()
+            time.sleep(options.loop_wait)
+            result = measure(cluster, writer, fault, options.duration)
+            result["run"] = run_number
+            logger.info("Run %s: %s" % (run_number, json.dumps(result)))
+            results.append(result)
+        writer.stopped = True
+    finally:
+        cluster.stop()
+
+    report = {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "options": vars(options),
+        "results": results,
+        "summary": summarise(results),
+    }
+    return report
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure governor failover under injected faults.")
+    parser.add_argument("--members", type=int, default=3)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--fault", choices=FAULTS, help="fault to inject every run; a seeded random one per run if omitted")
+    parser.add_argument("--duration", type=float, default=20, help="seconds etcd stays paused or slow")
+    parser.add_argument("--latency", type=float, default=2, help="seconds added to every etcd request for etcd_latency")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--template", default="postgres0.yml")
+    parser.add_argument("--workdir", default="data/bench")
+    parser.add_argument("--scope", default="bench")
+    parser.add_argument("--base-port", type=int, default=6432)
+    parser.add_argument("--ttl", type=int, default=30)
+    parser.add_argument("--api", choices=["v2", "v3"], default="v2", help="etcd api the governors use")
+    parser.add_argument("--loop-wait", type=int, default=10)
+    parser.add_argument("--write-interval", type=float, default=0.01)
+    parser.add_argument("--report", default="bench_report.json")
+    parser.add_argument("--baseline", help="earlier report to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed fractional slowdown against the baseline")
+    options = parser.parse_args()
+
+    report = run(options)
+    f = open(options.report, "w")
+    f.write(json.dumps(report, indent=2, sort_keys=True))
+    f.close()
+    print json.dumps(report["summary"], indent=2, sort_keys=True)
+
+    if options.baseline:
+        regressions = compare(report["summary"], json.load(open(options.baseline)), options.tolerance)
+        for regression in regressions:
+            print "REGRESSION %s" % regression
+        if regressions:
+            sys.exit(1)
@@ -1,11 +1,20 @@
 #!/usr/bin/env python
 
-import sys, os, yaml, time, urllib2, atexit, ssl
+import sys, os, yaml, time, urllib2, atexit, ssl, threading
 import logging
 
-from helpers.etcd import Etcd
+from helpers.etcd import etcd_client
 from helpers.postgresql import Postgresql
 from helpers.ha import Ha
+from helpers.watcher import watch_cluster
+from helpers.heartbeat import LeaderHeartbeat
+from helpers.watchdog import LeaseWatchdog
+from helpers.sync import SynchronousReplication
+from helpers.scheduler import Scheduler
+from helpers.haproxy import HAProxyRuntime
+from helpers.connection_pool import ConnectionPool
+from helpers.metrics import CYCLE_DURATION, REPLICATION_LAG, ORPHANED_SLOT_WAL
+from helpers.status import status_server
 
 LOG_LEVEL = logging.DEBUG if os.getenv('DEBUG', None) else logging.INFO
 
@@ -19,6 +28,7 @@ def stop_postgresql(postgresql):
 # wait for etcd to be available
 def wait_for_etcd(message, etcd, postgresql):
     etcd_ready = False
+    retry_wait = 1
     while not etcd_ready:
         try:
             etcd.touch_member(postgresql.name, postgresql.connection_string)
@@ -26,75 +36,236 @@ def wait_for_etcd(message, etcd, postgresql):
         except (urllib2.URLError, ssl.SSLError) as e:
             logging.info(e)
             logging.info("waiting on etcd: %s" % message)
-            time.sleep(5)
-
-def run(config):
-    etcd = Etcd(config["etcd"])
-    postgresql = Postgresql(config["postgresql"])
-    ha = Ha(postgresql, etcd)
-
-    atexit.register(stop_postgresql, postgresql)
-    logging.info("Governor Starting up")
-# is data directory empty?
-    if postgresql.data_directory_empty():
-        logging.info("Governor Starting up: Empty Data Dir")
-        # racing to initialize
-        wait_for_etcd("cannot initialize member without ETCD", etcd, postgresql)
-        if etcd.race("/initialize", postgresql.name):
-            logging.info("Governor Starting up: Initialisation Race ... WON!!!")
-            logging.info("Governor Starting up: Initialise Postgres")
-            postgresql.initialize()
-            logging.info("Governor Starting up: Initialise Complete")
-            etcd.take_leader(postgresql.name)
+            time.sleep(retry_wait)
+            retry_wait = min(retry_wait * 2, 5)
+
+# one Postgres instance and the HA loop for its scope
+class Governor:
+    def __init__(self, config, wakeup=None, pool=None, endpoints=None):
+        self.config = config
+        self.name = config["postgresql"]["name"]
+        self.pool = pool or ConnectionPool()
+        self.endpoints = endpoints
+        self.lease = None
+        self.etcd = self.connect_etcd()
+        # a stalled Postgres call may not hold up the loop for more than a third of the leader ttl
+        self.postgresql = Postgresql(config["postgresql"], retry_timeout=config["etcd"]["ttl"] / 3.0)
+        # the leader key is renewed from its own thread so a slow cycle cannot let it expire
+        self.wakeup = wakeup or threading.Event()
+        self.heartbeat = LeaderHeartbeat(self.connect_etcd(), self.postgresql, self.wakeup)
+        # role changes are pushed to HAProxy as they happen; its health checks remain the fallback
+        self.haproxy = None
+        if config.get("haproxy_runtime"):
+            self.haproxy = HAProxyRuntime(config["haproxy_runtime"], config["postgresql"]["listen"])
+        self.ha = Ha(self.postgresql, self.etcd, self.heartbeat, self.haproxy)
+        self.sync = None
+        if config["postgresql"].get("synchronous_mode"):
+            self.sync = SynchronousReplication(self.postgresql, self.etcd, config["postgresql"].get("synchronous_node_count", 1))
+        self.etcd_lost = False
+        self.retry_wait = 1
+
+    # every client of this governor shares one connection pool, and with it the sockets, and
+    # with the v3 api one lease, so that the heartbeat's keepalive covers every key of this member
+    def connect_etcd(self):
+        etcd = etcd_client(self.config["etcd"], pool=self.pool, endpoints=self.endpoints, lease=self.lease)
+        self.lease = etcd.lease
+        return etcd
+
+    def start(self):
+        self.heartbeat.start()
+        # fence the local primary before the lease runs out if nothing managed to renew it
+        watchdog = self.config.get("watchdog", {})
+        if watchdog.get("mode", "stop") != "off":
+            LeaseWatchdog(self.heartbeat, self.postgresql, watchdog.get("mode", "stop"), watchdog.get("safety_margin", 5), self.haproxy).start()
+
+        atexit.register(stop_postgresql, self.postgresql)
+
+        # serve the HAProxy checks and /metrics from this process
+        if self.config.get("haproxy_status", {}).get("embedded"):
+            server = status_server(self.config)
+            thread = threading.Thread(target=server.serve_forever, name="status server")
+            thread.daemon = True
+            thread.start()
+
+    def bootstrap(self):
+        etcd = self.etcd
+        postgresql = self.postgresql
+        logging.info("Governor Starting up")
+        # is data directory empty?
+        if postgresql.data_directory_empty():
+            logging.info("Governor Starting up: Empty Data Dir")
+            # racing to initialize
+            wait_for_etcd("cannot initialize member without ETCD", etcd, postgresql)
+            if etcd.race("/initialize", postgresql.name):
+                logging.info("Governor Starting up: Initialisation Race ... WON!!!")
+                logging.info("Governor Starting up: Initialise Postgres")
+                postgresql.initialize()
+                logging.info("Governor Starting up: Initialise Complete")
+                started = time.time()
+                etcd.take_leader(postgresql.name)
+                self.heartbeat.renewed(started)
+                logging.info("Governor Starting up: Starting Postgres")
+                postgresql.start()
+            else:
+                logging.info("Governor Starting up: Initialisation Race ... LOST")
+                logging.info("Governor Starting up: Sync Postgres from Leader")
+                synced_from_leader = False
+                retry_wait = 5
+                while not synced_from_leader:
+                    leader = etcd.current_leader()
+                    if not leader:
+                        time.sleep(5)
+                        continue
+                    if postgresql.sync_from_leader(leader, lambda progress: etcd.report_bootstrap(postgresql.name, progress)):
+                        logging.info("Governor Starting up: Sync Completed")
+                        postgresql.write_recovery_conf(leader)
+                        postgresql.save_state(leader)
+                        logging.info("Governor Starting up: Starting Postgres")
+                        postgresql.start()
+                        synced_from_leader = True
+                    else:
+                        logging.info("Governor Starting up: Sync Failed, retrying in %ss" % retry_wait)
+                        time.sleep(retry_wait)
+                        retry_wait = min(retry_wait * 2, 60)
+        else:
+            logging.info("Governor Starting up: Existing Data Dir")
+            # start once, already following the last known leader; the loop reconciles with etcd
+            state = postgresql.load_state()
+            leader = state and state.get("leader")
+            if leader and leader["hostname"] != postgresql.name:
+                logging.info("Governor Starting up: Following last known leader %s" % leader["hostname"])
+                postgresql.follow_the_leader(leader)
+            else:
+                postgresql.follow_no_leader()
             logging.info("Governor Starting up: Starting Postgres")
             postgresql.start()
-        else:
-            logging.info("Governor Starting up: Initialisation Race ... LOST")
-            logging.info("Governor Starting up: Sync Postgres from Leader")
-            synced_from_leader = False
-            while not synced_from_leader:
-                leader = etcd.current_leader()
-                if not leader:
-                    time.sleep(5)
-                    continue
-                if postgresql.sync_from_leader(leader):
-                    logging.info("Governor Starting up: Sync Completed")
-                    postgresql.write_recovery_conf(leader)
-                    logging.info("Governor Starting up: Starting Postgres")
-                    postgresql.start()
-                    synced_from_leader = True
-                else:
-                    time.sleep(5)
-    else:
-        logging.info("Governor Starting up: Existing Data Dir")
-        postgresql.follow_no_leader()
-        logging.info("Governor Starting up: Starting Postgres")
-        postgresql.start()
 
-    wait_for_etcd("running in readonly mode; cannot participate in cluster HA without etcd", etcd, postgresql)
-    logging.info("Governor Running: Starting Running Loop")
-    while True:
+        # watches on the leader key and members wake the loop early; loop_wait stays the fallback tick
+        if self.config["etcd"].get("watch"):
+            watch_cluster(self.connect_etcd(), self.wakeup, self.config["etcd"]["ttl"])
+
+    # one pass of the loop; returns the seconds until the next one is due
+    def cycle(self):
+        etcd = self.etcd
+        postgresql = self.postgresql
+        scope = self.config["etcd"]["scope"]
+
+        # without etcd, stay in readonly mode and only retry registering, backing off up to 5s
+        if self.etcd_lost:
+            try:
+                etcd.touch_member(postgresql.name, postgresql.connection_string)
+            except (urllib2.URLError, ssl.SSLError) as e:
+                logging.info(e)
+                logging.info("waiting on etcd: running in readonly mode; cannot participate in cluster HA without etcd")
+                self.retry_wait = min(self.retry_wait * 2, 5)
+                return self.retry_wait
+            self.etcd_lost = False
+
         try:
-            logging.info("Governor Running: %s" % ha.run_cycle())
-
-            # create replication slots
-            if postgresql.is_leader():
-                logging.info("Governor Running: I am the Leader")
-                for node in etcd.get_client_path("/members?recursive=true")["node"]["nodes"]:
-                    member = node["key"].split('/')[-1]
-                    if member != postgresql.name:
-                        postgresql.query("DO LANGUAGE plpgsql $$DECLARE somevar VARCHAR; BEGIN SELECT slot_name INTO somevar FROM pg_replication_slots WHERE slot_name = '%(slot)s' LIMIT 1; IF NOT FOUND THEN PERFORM pg_create_physical_replication_slot('%(slot)s'); END IF; END$$;" % {"slot": member})
-            etcd.touch_member(postgresql.name, postgresql.connection_string)
+            with CYCLE_DURATION.time():
+                logging.info("Governor Running: %s" % self.ha.run_cycle())
 
-            time.sleep(config["loop_wait"])
+                # create replication slots
+                if postgresql.is_leader():
+                    logging.info("Governor Running: I am the Leader")
+                    postgresql.save_state({"hostname": postgresql.name, "address": postgresql.connection_string}, postgresql.node_status()["timeline"])
+                    members = etcd.cluster().members() or []
+                    postgresql.sync_replication_slots(members)
+                    for slot, retained in postgresql.orphaned_slots.items():
+                        ORPHANED_SLOT_WAL.set(retained, scope=scope, slot=slot)
+                    ORPHANED_SLOT_WAL.retain([(scope, slot) for slot in postgresql.orphaned_slots.keys()], scope=scope)
+                    if self.sync is not None:
+                        self.sync.update(members)
+                    lag = postgresql.replication_lag()
+                    for member, lag_bytes in lag.items():
+                        REPLICATION_LAG.set(lag_bytes, scope=scope, member=member)
+                    REPLICATION_LAG.retain([(scope, member) for member in lag.keys()], scope=scope)
+                else:
+                    REPLICATION_LAG.retain([], scope=scope)
+                    ORPHANED_SLOT_WAL.retain([], scope=scope)
+                etcd.touch_member(postgresql.name, postgresql.member_status(etcd.last_leader_operation()))
         except urllib2.URLError:
             logging.info("Lost connection to etcd, setting no leader and waiting on etcd")
             postgresql.follow_no_leader()
-            wait_for_etcd("running in readonly mode; cannot participate in cluster HA without etcd", etcd, postgresql)
+            self.etcd_lost = True
+            self.retry_wait = 0.5
+            return 0
+
+        return self.config["loop_wait"]
+
+    def run(self):
+        self.postgresql.check_config()
+        self.start()
+        self.bootstrap()
+        logging.info("Governor Running: Starting Running Loop")
+        while True:
+            self.wakeup.wait(self.cycle())
+            self.wakeup.clear()
+
+def merge(base, override):
+    merged = dict(base)
+    for key, value in override.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = merge(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+# each entry under clusters is laid over the settings outside it
+def cluster_configs(config):
+    shared = dict([(key, value) for key, value in config.items() if key not in ("clusters", "workers")])
+    return [merge(shared, cluster) for cluster in config["clusters"]]
+
+# many clusters in one process: one etcd connection pool, one set of endpoints per etcd cluster
+# and one scheduler for the HA cycles. Each bootstrap runs on its own thread, so a long base
+# backup or a missing leader only holds up its own cluster.
+def run_clusters(config):
+    configs = cluster_configs(config)
+    logging.getLogger().handlers[0].setFormatter(logging.Formatter('%(asctime)s %(levelname)s [%(threadName)s]: %(message)s'))
+
+    scheduler = Scheduler(config.get("workers", len(configs)))
+    scheduler.start()
+    pool = ConnectionPool(maxsize=max(4, 2 * len(configs)))
+    endpoints = {}
+
+    def launch(governor, name):
+        while True:
+            try:
+                governor.bootstrap()
+                break
+            except Exception:
+                logging.exception("Could not start %s, retrying in 30s" % name)
+                time.sleep(30)
+        scheduler.add(name, governor.cycle, governor.config["loop_wait"])
+
+    for cluster in configs:
+        etcd_config = cluster["etcd"]
+        key = (repr(etcd_config["endpoint"]), repr(etcd_config.get("authentication")))
+        if key not in endpoints:
+            endpoints[key] = etcd_client(etcd_config, pool=pool).endpoints
+
+        name = "%s/%s" % (etcd_config["scope"], cluster["postgresql"]["name"])
+        governor = Governor(cluster, scheduler.wakeup(name), pool, endpoints[key])
+        # a misconfigured cluster is left out; the others start regardless
+        try:
+            governor.postgresql.check_config()
+        except (ValueError, OSError) as e:
+            logging.error("Not starting %s: %s" % (name, e))
+            continue
+        governor.start()
+        thread = threading.Thread(target=launch, args=(governor, name), name=name)
+        thread.daemon = True
+        thread.start()
+
+    while True:
+        time.sleep(3600)
 
 if __name__ == "__main__":
     f = open(sys.argv[1], "r")
     config = yaml.load(f.read())
     f.close()
 
-    run(config)
+    if "clusters" in config:
+        run_clusters(config)
+    else:
+        Governor(config).run()
@@ -0,0 +1,67 @@
+import os, re, time, subprocess
+import logging
+
+logger = logging.getLogger(__name__)
+
+PROGRESS = re.compile(r"(\d+)/(\d+) kB")
+
+class BaseBackup:
+    def __init__(self, command, env, report_interval=10, progress=None):
+        self.command = command
+        self.env = env
+        self.report_interval = report_interval
+        self.progress = progress
+        self.done = 0
+        self.total = None
+        self.started_at = None
+        self.reported_at = None
+
+    def run(self):
+        logger.info("Running %s" % " ".join(self.command))
+        self.started_at = time.time()
+        self.reported_at = self.started_at
+        process = subprocess.Popen(self.command, env=self.env, stderr=subprocess.PIPE, close_fds=True)
+
+        # --progress rewrites one status line with \r, so split on either line ending
+        line = ""
+        while True:
+            chunk = os.read(process.stderr.fileno(), 4096)
+            if not chunk:
+                break
+            for char in chunk:
+                if char in "\r\n":
+                    self.parse(line)
+                    line = ""
+                else:
+                    line += char
+        self.parse(line)
+
+        succeeded = process.wait() == 0
+        self.report(succeeded and "finished" or "failed")
+        return succeeded
+
+    def parse(self, line):
+        match = PROGRESS.search(line)
+        if match is None:
+            if line.strip():
+                logger.info(line.strip())
+            return
+
+        self.done, self.total = int(match.group(1)) * 1024, int(match.group(2)) * 1024
+        if time.time() - self.reported_at >= self.report_interval:
+            self.report("running")
+
+    def throughput(self):
+        elapsed = time.time() - self.started_at
+        if elapsed <= 0:
+            return 0
+        return self.done / elapsed
+
+    def report(self, state):
+        self.reported_at = time.time()
+        logger.info("Base backup %s: %s of %s bytes, %.0f bytes/s" % (state, self.done, self.total, self.throughput()))
+        if self.progress is not None:
+            try:
+                self.progress({"state": state, "bytes": self.done, "total": self.total, "throughput": int(self.throughput())})
+            except Exception as e:
+                logger.warning("Could not publish base backup progress: %s" % e)
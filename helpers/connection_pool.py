@@ -0,0 +1,96 @@
+import httplib, socket, select, threading, urllib2
+import logging
+from StringIO import StringIO
+from urlparse import urlparse
+
+logger = logging.getLogger(__name__)
+
+class ConnectionPool:
+    def __init__(self, maxsize=4):
+        self.maxsize = maxsize
+        self.idle = {}
+        self.lock = threading.Lock()
+
+    def request(self, method, url, body=None, headers=None, timeout=None):
+        parsed = urlparse(url)
+        key = (parsed.scheme, parsed.hostname, parsed.port)
+        path = parsed.path or "/"
+        if parsed.query:
+            path = "%s?%s" % (path, parsed.query)
+
+        # a pooled socket may have been closed by the server while it sat idle;
+        # that shows up as a failure before any response, so retry once on a fresh one
+        conn, reused = self.checkout(key, timeout)
+        try:
+            response = self.send(conn, method, path, body, headers)
+        except (httplib.HTTPException, socket.error) as e:
+            conn.close()
+            if not reused or isinstance(e, socket.timeout):
+                raise urllib2.URLError(e)
+            conn, reused = self.connect(key, timeout), False
+            try:
+                response = self.send(conn, method, path, body, headers)
+            except (httplib.HTTPException, socket.error) as e:
+                conn.close()
+                raise urllib2.URLError(e)
+
+        try:
+            data = response.read()
+        except (httplib.HTTPException, socket.error) as e:
+            conn.close()
+            raise urllib2.URLError(e)
+
+        if response.will_close:
+            conn.close()
+        else:
+            self.checkin(key, conn)
+
+        if response.status >= 400:
+            raise urllib2.HTTPError(url, response.status, response.reason, response.msg, StringIO(data))
+        return response.msg, data
+
+    def send(self, conn, method, path, body, headers):
+        conn.request(method, path, body, headers or {})
+        return conn.getresponse()
+
+    def checkout(self, key, timeout):
+        with self.lock:
+            connections = self.idle.get(key, [])
+            while connections:
+                conn = connections.pop()
+                if self.is_alive(conn):
+                    conn.sock.settimeout(timeout)
+                    return conn, True
+                conn.close()
+        return self.connect(key, timeout), False
+
+    def checkin(self, key, conn):
+        with self.lock:
+            connections = self.idle.setdefault(key, [])
+            if len(connections) < self.maxsize:
+                connections.append(conn)
+                return
+        conn.close()
+
+    def connect(self, key, timeout):
+        scheme, host, port = key
+        if scheme == "https":
+            return httplib.HTTPSConnection(host, port, timeout=timeout)
+        return httplib.HTTPConnection(host, port, timeout=timeout)
+
+    # an idle keep-alive socket should have nothing to read; EOF or stray data means it is dead
+    def is_alive(self, conn):
+        if conn.sock is None:
+            return False
+        try:
+            readable, _, _ = select.select([conn.sock], [], [], 0)
+        except (select.error, socket.error, ValueError):
+            return False
+        return not readable
+
+    def close(self):
+        with self.lock:
+            for connections in self.idle.values():
+                for conn in connections:
+                    conn.close()
+            self.idle = {}
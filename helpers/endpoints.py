@@ -0,0 +1,160 @@
+import threading, time, json, urllib2, Queue
+import logging
+from helpers.metrics import ETCD_REQUEST_DURATION
+
+logger = logging.getLogger(__name__)
+
+class Endpoint:
+    def __init__(self, url):
+        self.url = url.rstrip("/")
+        self.latency = None
+        self.failures = 0
+        self.failed_at = None
+
+    def succeeded(self, latency):
+        # exponentially weighted, so one slow answer does not demote a good peer
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency = 0.8 * self.latency + 0.2 * latency
+        self.failures = 0
+        self.failed_at = None
+
+    def failed(self):
+        self.failures += 1
+        self.failed_at = time.time()
+
+class Endpoints:
+    def __init__(self, urls, pool, headers, timeout, hedge_delay=None, discovery_interval=60):
+        self.endpoints = [Endpoint(url) for url in urls]
+        self.pool = pool
+        self.headers = headers
+        self.timeout = timeout
+        self.hedge_delay = hedge_delay
+        self.discovery_interval = discovery_interval
+        self.discovered_at = None
+        self.lock = threading.Lock()
+
+    # healthy peers by latency first, then the ones that failed recently, longest ago first
+    def ranked(self):
+        self.discover()
+        with self.lock:
+            endpoints = list(self.endpoints)
+        quarantine = time.time() - 2 * self.timeout
+        healthy = [e for e in endpoints if e.failed_at is None or e.failed_at < quarantine]
+        failing = [e for e in endpoints if e not in healthy]
+        healthy.sort(key=lambda e: e.latency is None and -1 or e.latency)
+        failing.sort(key=lambda e: e.failed_at)
+        return healthy + failing
+
+    # add the client urls of every etcd cluster member to the configured ones
+    def discover(self):
+        if self.discovered_at is not None and time.time() - self.discovered_at < self.discovery_interval:
+            return
+        self.discovered_at = time.time()
+
+        with self.lock:
+            endpoints = list(self.endpoints)
+        quarantine = time.time() - 2 * self.timeout
+        for endpoint in endpoints:
+            if endpoint.failed_at is not None and endpoint.failed_at >= quarantine:
+                continue
+            try:
+                headers, response = self.pool.request("GET", "%s/v2/members" % endpoint.url, headers=self.headers, timeout=self.timeout)
+                urls = []
+                for member in json.loads(response).get("members", []):
+                    urls += member.get("clientURLs", [])
+            except (urllib2.URLError, ValueError) as e:
+                logger.debug("Could not discover etcd members from %s: %s" % (endpoint.url, e))
+                continue
+
+            with self.lock:
+                known = set([e.url for e in self.endpoints])
+                for url in urls:
+                    if url.rstrip("/") not in known:
+                        logger.info("Discovered etcd endpoint %s" % url)
+                        self.endpoints.append(Endpoint(url))
+            return
+
+    def attempt(self, endpoint, method, path, body, headers, timeout, record):
+        started = time.time()
+        try:
+            result = self.pool.request(method, endpoint.url + path, body=body, headers=headers, timeout=timeout)
+        except urllib2.HTTPError:
+            # etcd answered, it just said no
+            if record:
+                endpoint.succeeded(time.time() - started)
+            raise
+        except urllib2.URLError:
+            # a long poll that runs out of time says nothing about the endpoint; any other
+            # request that does, a blackholed peer among them, counts against it
+            if record:
+                endpoint.failed()
+            raise
+        finally:
+            if record:
+                ETCD_REQUEST_DURATION.observe(time.time() - started, method=method)
+        if record:
+            endpoint.succeeded(time.time() - started)
+        return result
+
+    # try each peer in turn until one answers; an HTTP error is an answer
+    def request(self, method, path, body=None, headers=None, timeout=None, record=True):
+        error = None
+        for endpoint in self.ranked():
+            try:
+                return self.attempt(endpoint, method, path, body, headers, timeout, record)
+            except urllib2.HTTPError:
+                raise
+            except urllib2.URLError as e:
+                # nor is it worth repeating against another peer; the caller polls again
+                if not record:
+                    raise
+                logger.warning("etcd endpoint %s failed: %s" % (endpoint.url, e))
+                error = e
+        raise error
+
+    # send a read to the fastest peer, and to the next one as well if it has not answered within hedge_delay
+    def hedged_request(self, path, headers=None, timeout=None):
+        endpoints = self.ranked()
+        if self.hedge_delay is None or len(endpoints) < 2:
+            return self.request("GET", path, headers=headers, timeout=timeout)
+
+        results = Queue.Queue()
+        def attempt(endpoint):
+            try:
+                results.put((True, self.attempt(endpoint, "GET", path, None, headers, timeout, True)))
+            except urllib2.URLError as e:
+                results.put((False, e))
+
+        def launch():
+            thread = threading.Thread(target=attempt, args=(endpoints.pop(0),))
+            thread.daemon = True
+            thread.start()
+
+        launch()
+        pending, error = 1, None
+        while pending:
+            try:
+                if endpoints:
+                    succeeded, value = results.get(True, self.hedge_delay)
+                else:
+                    # every attempt carries its own socket timeout; this is only a backstop
+                    succeeded, value = results.get(True, 2 * (timeout or self.timeout))
+            except Queue.Empty:
+                if not endpoints:
+                    raise urllib2.URLError("no etcd endpoint answered %s" % path)
+                launch()
+                pending += 1
+                continue
+
+            pending -= 1
+            if succeeded:
+                return value
+            if isinstance(value, urllib2.HTTPError):
+                raise value
+            error = value
+            if endpoints:
+                launch()
+                pending += 1
+        raise error
@@ -2,31 +2,49 @@ import urllib2, json, os, time, base64, ssl
 import logging
 from urllib import urlencode
 import helpers.errors
+from helpers.connection_pool import ConnectionPool
+from helpers.endpoints import Endpoints
 
 logger = logging.getLogger(__name__)
 
 class Etcd:
-    def __init__(self, config):
+    # pool and endpoints can be shared between clients, including clients of other scopes
+    def __init__(self, config, pool=None, endpoints=None):
         self.scope = config["scope"]
-        self.endpoint = config["endpoint"]
+        if isinstance(config["endpoint"], list):
+            urls = config["endpoint"]
+        else:
+            urls = [config["endpoint"]]
         if config.has_key("authentication"):
             self.authentication = config["authentication"]
         else:
             self.authentication = None
         self.ttl = config["ttl"]
         self.timeout = config["timeout"]
+        self.snapshot = None
+
+        self.headers = {}
+        if self.authentication is not None:
+            base64string = base64.b64encode('%s:%s' % (self.authentication["username"], self.authentication["password"]))
+            self.headers["Authorization"] = "Basic %s" % base64string
+        self.pool = pool or ConnectionPool()
+        self.endpoints = endpoints or Endpoints(urls, self.pool, self.headers, self.timeout, config.get("hedge_delay", 1))
+        # keys carry their own ttls here; only the v3 client holds a lease
+        self.lease = None
 
-    def get_client_path(self, path, max_attempts=1):
+    def get_client_path(self, path, max_attempts=1, timeout=None):
         attempts = 0
         response = None
+        index = None
 
         while True:
             try:
-                request = urllib2.Request(self.client_url(path))
-                if self.authentication is not None:
-                    base64string = base64.encodestring('%s:%s' % (self.authentication["username"], self.authentication["password"])).replace('\n', '')
-                    request.add_header("Authorization", "Basic %s" % base64string)
-                response = urllib2.urlopen(request, timeout=self.timeout).read()
+                if timeout is None:
+                    headers, response = self.endpoints.hedged_request(self.client_url(path), headers=self.headers, timeout=self.timeout)
+                else:
+                    # long polls are neither hedged nor counted as latency
+                    headers, response = self.endpoints.request("GET", self.client_url(path), headers=self.headers, timeout=timeout, record=False)
+                index = headers.getheader("X-Etcd-Index")
                 break
             except (urllib2.HTTPError, urllib2.URLError, ssl.SSLError) as e:
                 attempts += 1
@@ -36,27 +54,76 @@ class Etcd:
                 else:
                     raise e
         try:
-            return json.loads(response)
+            result = json.loads(response)
         except ValueError:
             return response
+        if index is not None and isinstance(result, dict):
+            result["etcdIndex"] = int(index)
+        return result
 
     def put_client_path(self, path, data):
-        request = urllib2.Request(self.client_url(path), data=urlencode(data).replace("false", "False"))
-        if self.authentication is not None:
-            base64string = base64.encodestring('%s:%s' % (self.authentication["username"], self.authentication["password"])).replace('\n', '')
-            request.add_header("Authorization", "Basic %s" % base64string)
-        request.get_method = lambda: 'PUT'
-        urllib2.urlopen(request, timeout=self.timeout).read()
+        headers = dict(self.headers)
+        headers["Content-Type"] = "application/x-www-form-urlencoded"
+        self.endpoints.request("PUT", self.client_url(path), body=urlencode(data), headers=headers, timeout=self.timeout)
+
+    def delete(self, path, prev_value=None):
+        url = self.client_url(path)
+        if prev_value is not None:
+            url += "?" + urlencode({"prevValue": prev_value})
+        self.endpoints.request("DELETE", url, headers=self.headers, timeout=self.timeout)
 
+    # relative to whichever etcd endpoint serves the request
     def client_url(self, path):
-        return "%s/v2/keys/service/%s%s" % (self.endpoint, self.scope, path)
+        return "/v2/keys%s%s" % (self.scope_path(), path)
+
+    def scope_path(self):
+        return "/service/%s" % self.scope
+
+    def fetch_snapshot(self):
+        try:
+            return ClusterSnapshot(self.scope_path(), self.get_client_path("?recursive=true"))
+        except urllib2.HTTPError as e:
+            if e.code == 404:
+                snapshot = ClusterSnapshot(self.scope_path(), None)
+                index = e.info().getheader("X-Etcd-Index")
+                if index is not None:
+                    snapshot.index = int(index)
+                return snapshot
+            raise e
+
+    # reads are answered from the snapshot until the next refresh, or
+    # from a fresh recursive read when there is no snapshot
+    def cluster(self):
+        if self.snapshot is not None:
+            return self.snapshot
+        return self.fetch_snapshot()
+
+    def refresh_snapshot(self):
+        try:
+            self.snapshot = self.fetch_snapshot()
+        except (urllib2.HTTPError, urllib2.URLError, ssl.SSLError) as e:
+            logger.warning("Could not read cluster state from etcd: %s" % e)
+            self.snapshot = None
+        return self.snapshot
+
+    def clear_snapshot(self):
+        self.snapshot = None
+
+    # long-poll until something under path changes after index, or timeout
+    def watch(self, path, index, timeout):
+        return self.get_client_path("%s?wait=true&recursive=true&waitIndex=%s" % (path, index), timeout=timeout)
 
     def current_leader(self):
         try:
-            hostname = self.get_client_path("/leader")["node"]["value"]
-            address = self.get_client_path("/members/%s" % hostname)["node"]["value"]
+            cluster = self.cluster()
+            hostname = cluster.leader()
+            if hostname is None:
+                return None
+            member = cluster.get("/members/%s" % hostname)
+            if member is None:
+                return None
 
-            return {"hostname": hostname, "address": address}
+            return parse_member(hostname, member["value"])
         except urllib2.HTTPError as e:
             if e.code == 404:
                 return None
@@ -66,13 +133,7 @@ class Etcd:
 
     def members(self):
         try:
-            members = []
-
-            r = self.get_client_path("/members?recursive=true")
-            for node in r["node"]["nodes"]:
-                members.append({"hostname": node["key"].split('/')[-1], "address": node["value"]})
-
-            return members
+            return self.cluster().members()
         except urllib2.HTTPError as e:
             if e.code == 404:
                 return None
@@ -81,10 +142,17 @@ class Etcd:
             raise helpers.errors.CurrentLeaderError("Etcd is not responding properly")
 
 
-    def touch_member(self, member, connection_string):
-        self.put_client_path("/members/%s" % member, {"value": connection_string, "ttl": self.ttl})
+    # value is either the bare connection string or the status record from Postgresql.member_status
+    def touch_member(self, member, value):
+        if isinstance(value, dict):
+            value = json.dumps(value, sort_keys=True)
+        self.put_client_path("/members/%s" % member, {"value": value, "ttl": self.ttl})
+
+    def report_bootstrap(self, member, progress):
+        self.put_client_path("/bootstrap/%s" % member, {"value": json.dumps(progress), "ttl": self.ttl})
 
     def take_leader(self, value):
+        self.clear_snapshot()
         return self.put_client_path("/leader", {"value": value, "ttl": self.ttl}) == None
 
     def attempt_to_acquire_leader(self, value):
@@ -93,21 +161,41 @@ class Etcd:
         except urllib2.HTTPError as e:
             if e.code == 412:
                 logger.info("Could not take out TTL lock: %s" % e)
+            # someone else holds the lock now; the snapshot no longer says who
+            self.clear_snapshot()
             return False
         except (urllib2.URLError, ssl.SSLError):
+            self.clear_snapshot()
             return False
 
     def update_leader(self, state_handler):
         try:
             self.put_client_path("/leader", {"value": state_handler.name, "ttl": self.ttl, "prevValue": state_handler.name})
             self.put_client_path("/optime/leader", {"value": state_handler.last_operation()})
+            return True
         except (urllib2.HTTPError, urllib2.URLError) as e:
             logger.error("Error updating leader lock and optime on ETCD for primary.")
             return False
 
+    # refresh the ttl only; True when renewed, False when the lock is someone else's, None when unknown
+    def renew_leader(self, value):
+        try:
+            self.put_client_path("/leader", {"value": value, "ttl": self.ttl, "prevValue": value})
+            return True
+        except urllib2.HTTPError as e:
+            if e.code in (404, 412):
+                return False
+            logger.error("Error renewing leader lock: %s" % e)
+        except (urllib2.URLError, ssl.SSLError) as e:
+            logger.error("Error renewing leader lock: %s" % e)
+        return None
+
     def last_leader_operation(self):
         try:
-            return int(self.get_client_path("/optime/leader")["node"]["value"])
+            optime = self.cluster().get("/optime/leader")
+            if optime is None:
+                return None
+            return int(optime["value"])
         except urllib2.HTTPError as e:
             if e.code == 404:
                 logger.error("Error updating TTL on ETCD for primary.")
@@ -116,10 +204,62 @@ class Etcd:
                 logger.error("Error updating TTL on ETCD for primary.")
                 return None
 
+    # give up the lock only if it is still ours; True when released
+    def release_leader(self, value):
+        self.clear_snapshot()
+        try:
+            self.delete("/leader", prev_value=value)
+            return True
+        except urllib2.HTTPError as e:
+            logger.error("Could not release leader lock: %s" % e)
+        except (urllib2.URLError, ssl.SSLError) as e:
+            logger.error("Could not release leader lock: %s" % e)
+        return False
+
+    # a requested handover of the leader lock to a named member, None when there is none
+    def switchover(self):
+        try:
+            node = self.cluster().get("/switchover")
+            if node is None:
+                return None
+            return json.loads(node["value"])
+        except (urllib2.URLError, ssl.SSLError, ValueError) as e:
+            logger.error("Could not read the switchover request: %s" % e)
+            return None
+
+    def request_switchover(self, leader, member, ttl):
+        self.put_client_path("/switchover", {"value": json.dumps({"leader": leader, "member": member}, sort_keys=True), "ttl": ttl})
+
+    def clear_switchover(self):
+        try:
+            self.delete("/switchover")
+        except urllib2.HTTPError as e:
+            if e.code != 404:
+                logger.error("Could not clear the switchover request: %s" % e)
+        except (urllib2.URLError, ssl.SSLError) as e:
+            logger.error("Could not clear the switchover request: %s" % e)
+
+    # the leader and the standbys it last saw confirmed as synchronous, None when not recorded
+    def sync_state(self):
+        try:
+            node = self.cluster().get("/sync")
+            if node is None:
+                return None
+            return json.loads(node["value"])
+        except (urllib2.URLError, ssl.SSLError, ValueError) as e:
+            logger.error("Could not read the synchronous standby set: %s" % e)
+            return None
+
+    def set_sync_state(self, leader, standbys):
+        value = json.dumps({"leader": leader, "sync_standby": standbys}, sort_keys=True)
+        node = self.snapshot is not None and self.snapshot.get("/sync") or None
+        if node is not None and node["value"] == value:
+            return
+        self.put_client_path("/sync", {"value": value})
+
     def leader_unlocked(self):
         try:
-            self.get_client_path("/leader")
-            return False
+            return self.cluster().leader() is None
         except urllib2.HTTPError as e:
             if e.code == 404:
                 return True
@@ -133,14 +273,15 @@ class Etcd:
 
     def am_i_leader(self, value):
         try:
-            reponse = self.get_client_path("/leader")
-            logger.info("Lock owner: %s; I am %s" % (reponse["node"]["value"], value))
-            return reponse["node"]["value"] == value
+            owner = self.cluster().leader()
+            logger.info("Lock owner: %s; I am %s" % (owner, value))
+            return owner == value
         except (urllib2.HTTPError, ssl.SSLError, urllib2.URLError):
             logger.error("Couldn't reach etcd")
             return False
 
     def race(self, path, value):
+        retry_wait = 1
         while True:
             try:
                 return self.put_client_path(path, {"prevExist": False, "value": value}) == None
@@ -149,7 +290,66 @@ class Etcd:
                     return False
                 else:
                     logger.warning("etcd is not ready for connections")
-                    time.sleep(10)
             except (urllib2.URLError, ssl.SSLError):
                     logger.warning("Issue connecting to etcd")
-                    time.sleep(10)
+            time.sleep(retry_wait)
+            retry_wait = min(retry_wait * 2, 10)
+
+
+# the client for the API the config asks for; clients of one member share its lease
+def etcd_client(config, pool=None, endpoints=None, lease=None):
+    if config.get("api", "v2") == "v3":
+        from helpers.etcd3 import Etcd3
+        return Etcd3(config, pool, endpoints, lease)
+    return Etcd(config, pool, endpoints)
+
+
+class ClusterSnapshot:
+    def __init__(self, prefix, response):
+        self.prefix = prefix
+        self.nodes = {}
+        self.index = None
+        if response is not None:
+            self.index = response.get("etcdIndex")
+            self.load(response["node"])
+
+    def load(self, node):
+        key = node.get("key", self.prefix)[len(self.prefix):]
+        self.nodes[key] = node
+        for child in node.get("nodes", []):
+            self.load(child)
+
+    def get(self, path):
+        node = self.nodes.get(path)
+        if node is None or node.get("dir"):
+            return None
+        return node
+
+    def leader(self):
+        node = self.get("/leader")
+        if node is None:
+            return None
+        return node["value"]
+
+    def members(self):
+        directory = self.nodes.get("/members")
+        if directory is None:
+            return None
+
+        members = []
+        for node in directory.get("nodes", []):
+            members.append(parse_member(node["key"].split('/')[-1], node["value"]))
+        return members
+
+# a member key holds either a JSON status record with a conn_url, or, from older
+# governors and before Postgres is up, the bare connection string
+def parse_member(hostname, value):
+    try:
+        status = json.loads(value)
+    except ValueError:
+        status = None
+    if not isinstance(status, dict) or "conn_url" not in status:
+        return {"hostname": hostname, "address": value}
+    member = dict(status)
+    member.update(hostname=hostname, address=status["conn_url"])
+    return member
@@ -0,0 +1,283 @@
+import urllib2, json, time, base64, ssl, socket, httplib, threading
+import logging
+from StringIO import StringIO
+from urlparse import urlparse
+from helpers.etcd import Etcd, ClusterSnapshot
+
+logger = logging.getLogger(__name__)
+
+# The etcd v3 API through its JSON gateway. The keys and the snapshot look the same as with v2,
+# but the member key, the leader key and bootstrap progress are attached to one lease per member
+# instead of carrying ttls of their own: one keepalive refreshes all of them, and when the member
+# stops renewing they expire together. Every v2-style conditional write is a transaction.
+class Etcd3(Etcd):
+    def __init__(self, config, pool=None, endpoints=None, lease=None):
+        Etcd.__init__(self, config, pool, endpoints)
+        self.api = config.get("api_prefix", "/v3")
+        # clients of the same member share the lease, so a keepalive from the heartbeat counts for all
+        self.lease = lease or Lease(self.ttl)
+        self.token = None
+        # the leader's position, written with the member key by the next touch_member
+        self.optime = None
+
+    def request_headers(self):
+        headers = {"Content-Type": "application/json"}
+        if self.authentication is not None:
+            if self.token is None:
+                _, response = self.endpoints.request("POST", self.api + "/auth/authenticate", headers=headers, timeout=self.timeout,
+                                                     body=json.dumps({"name": self.authentication["username"], "password": self.authentication["password"]}))
+                self.token = json.loads(response)["token"]
+            headers["Authorization"] = self.token
+        return headers
+
+    def post(self, path, body):
+        try:
+            headers, response = self.endpoints.request("POST", self.api + path, body=json.dumps(body), headers=self.request_headers(), timeout=self.timeout)
+        except urllib2.HTTPError as e:
+            # an expired auth token; the next request authenticates again
+            if e.code == 401:
+                self.token = None
+            raise e
+        return json.loads(response)
+
+    def key(self, path):
+        return encode(self.scope_path() + path)
+
+    def put_request(self, path, value, lease=None):
+        put = {"key": self.key(path), "value": encode(value)}
+        if lease is not None:
+            put["lease"] = lease
+        return {"request_put": put}
+
+    def txn(self, compare, success, failure=None):
+        response = self.post("/kv/txn", {"compare": compare, "success": success, "failure": failure or []})
+        return response.get("succeeded", False)
+
+    # a failed comparison is raised as the HTTP error v2 would have answered, so the
+    # callers shared with the v2 client handle both
+    def put_client_path(self, path, data):
+        lease = None
+        if data.get("ttl") is not None:
+            lease = self.lease_id()
+        put = self.put_request(path, data["value"], lease)
+        if data.get("prevExist") is False:
+            compare = [{"key": self.key(path), "target": "CREATE", "result": "EQUAL", "create_revision": "0"}]
+        elif data.get("prevValue") is not None:
+            compare = [value_equals(self.key(path), data["prevValue"])]
+        else:
+            self.post("/kv/put", put["request_put"])
+            return None
+        if not self.txn(compare, [put]):
+            raise compare_failed(path)
+        return None
+
+    def delete(self, path, prev_value=None):
+        delete = {"request_delete_range": {"key": self.key(path)}}
+        if prev_value is None:
+            if int(self.post("/kv/deleterange", delete["request_delete_range"]).get("deleted", 0)) == 0:
+                raise urllib2.HTTPError(self.api + "/kv/deleterange", 404, "Key not found", None, StringIO(path))
+        elif not self.txn([value_equals(self.key(path), prev_value)], [delete]):
+            raise compare_failed(path)
+
+    def lease_id(self):
+        with self.lease.lock:
+            if self.lease.id is None:
+                started = time.time()
+                response = self.post("/lease/grant", {"TTL": self.ttl})
+                self.lease.id = response["ID"]
+                self.lease.kept_alive_at = started
+            return self.lease.id
+
+    # True when the lease was refreshed, False when it has expired, None when etcd did not answer
+    def keepalive(self):
+        started = time.time()
+        try:
+            lease = self.lease_id()
+            result = self.post("/lease/keepalive", {"ID": lease}).get("result", {})
+        except (urllib2.HTTPError, urllib2.URLError, ssl.SSLError, ValueError, KeyError) as e:
+            logger.error("Error renewing lease: %s" % e)
+            return None
+        with self.lease.lock:
+            if int(result.get("TTL", 0)) <= 0:
+                # everything attached to it is gone; the next write takes out a new lease
+                logger.warning("Lease %s has expired" % lease)
+                if self.lease.id == lease:
+                    self.lease.id = None
+                return False
+            self.lease.kept_alive_at = max(started, self.lease.kept_alive_at)
+        return True
+
+    def fetch_snapshot(self):
+        prefix = self.scope_path() + "/"
+        response = self.post("/kv/range", {"key": encode(prefix), "range_end": encode(prefix_end(prefix))})
+        revision = int(response["header"]["revision"])
+        kvs = response.get("kvs", [])
+        if not kvs:
+            snapshot = ClusterSnapshot(self.scope_path(), None)
+            snapshot.index = revision
+            return snapshot
+        return ClusterSnapshot(self.scope_path(), {"node": self.tree(kvs), "etcdIndex": revision})
+
+    # the v2 directory tree ClusterSnapshot reads
+    def tree(self, kvs):
+        root = {"key": self.scope_path(), "dir": True, "nodes": []}
+        directories = {root["key"]: root}
+        for kv in sorted(kvs, key=lambda kv: decode(kv["key"])):
+            node = self.node(kv)
+            parent = root
+            for part in node["key"][len(root["key"]) + 1:].split("/")[:-1]:
+                path = "%s/%s" % (parent["key"], part)
+                if path not in directories:
+                    directories[path] = {"key": path, "dir": True, "nodes": []}
+                    parent["nodes"].append(directories[path])
+                parent = directories[path]
+            parent["nodes"].append(node)
+        return root
+
+    def node(self, kv):
+        node = {"key": decode(kv["key"]), "value": decode(kv.get("value", "")),
+                "createdIndex": int(kv.get("create_revision", 0)), "modifiedIndex": int(kv.get("mod_revision", 0))}
+        # only the holder knows when its lease runs out without asking etcd
+        if kv.get("lease") is not None and kv["lease"] == self.lease.id and self.lease.kept_alive_at is not None:
+            node["ttl"] = max(0, int(self.ttl - (time.time() - self.lease.kept_alive_at)))
+        return node
+
+    # wait for the first event under path from index on, in the shape of a v2 watch answer. The
+    # gateway streams watch responses, so this reads them off its own connection
+    def watch(self, path, index, timeout):
+        key = self.scope_path() + path
+        body = {"create_request": {"key": encode(key), "range_end": encode(prefix_end(key)), "start_revision": index, "prev_kv": True}}
+        url = urlparse(self.endpoints.ranked()[0].url)
+        connection = url.scheme == "https" and httplib.HTTPSConnection or httplib.HTTPConnection
+        conn = connection(url.hostname, url.port, timeout=timeout)
+        try:
+            conn.request("POST", self.api + "/watch", json.dumps(body), self.request_headers())
+            response = conn.getresponse()
+            if response.status != 200:
+                raise urllib2.HTTPError(self.api + "/watch", response.status, response.reason, response.msg, StringIO(response.read()))
+            while True:
+                result = json.loads(read_line(response)).get("result", {})
+                if result.get("canceled") or result.get("compact_revision"):
+                    # index fell out of etcd's history, as a v2 watch answers with 400
+                    raise urllib2.HTTPError(self.api + "/watch", 400, "compacted", None, StringIO(""))
+                for event in result.get("events", []):
+                    return self.event(event)
+        except (httplib.HTTPException, socket.error) as e:
+            if isinstance(e, socket.timeout):
+                raise e
+            raise urllib2.URLError(e)
+        finally:
+            conn.close()
+
+    def event(self, event):
+        # the gateway leaves out PUT, the default event type
+        deleted = event.get("type") == "DELETE"
+        node = self.node(event["kv"])
+        if deleted:
+            del node["value"]
+        response = {"action": deleted and "delete" or "set", "node": node}
+        if event.get("prev_kv") is not None:
+            response["prevNode"] = self.node(event["prev_kv"])
+        return response
+
+    # the member key, and on the leader its position, in one transaction; the lease is renewed
+    # here only when the heartbeat has not done so for half a ttl
+    def touch_member(self, member, value):
+        if isinstance(value, dict):
+            value = json.dumps(value, sort_keys=True)
+        if self.lease.kept_alive_at is not None and time.time() - self.lease.kept_alive_at > self.ttl / 2.0:
+            self.keepalive()
+        put = self.put_request("/members/%s" % member, value, self.lease_id())
+        if self.optime is None:
+            self.post("/kv/put", put["request_put"])
+            return
+        optime, self.optime = self.optime, None
+        if not self.txn(self.leader_held(member), [put, self.put_request("/optime/leader", str(optime))], [put]):
+            logger.warning("The leader lock is no longer held by %s, not publishing its position" % member)
+            self.clear_snapshot()
+
+    # the lease is counted from when it was last renewed, which may be long before the caller's
+    # start time; renew it first so that the caller's start time is a safe bound
+    def take_leader(self, value):
+        self.keepalive()
+        return Etcd.take_leader(self, value)
+
+    def attempt_to_acquire_leader(self, value):
+        if self.keepalive() is None:
+            self.clear_snapshot()
+            return False
+        return Etcd.attempt_to_acquire_leader(self, value)
+
+    # the leader key needs no rewrite while its lease lives. Whether the key is still ours and on
+    # the lease is read from this cycle's snapshot, the lease is kept alive here only when the
+    # heartbeat has not done so for a third of a ttl, and the position goes out with the member
+    # key in a transaction guarded on the leader key
+    def update_leader(self, state_handler):
+        try:
+            leader = self.cluster().get("/leader")
+        except (urllib2.HTTPError, urllib2.URLError, ssl.SSLError, ValueError) as e:
+            logger.error("Error reading the leader lock: %s" % e)
+            return False
+        # only a key on our own lease carries a ttl
+        if leader is None or leader.get("value") != state_handler.name or "ttl" not in leader:
+            return False
+        if time.time() - self.lease.kept_alive_at > self.ttl / 3.0 and not self.keepalive():
+            return False
+        self.optime = state_handler.last_operation()
+        return True
+
+    # a live lease alone does not mean the leader key is still on it: it may have been released or
+    # taken over, so the key's value and lease are checked after the keepalive
+    def renew_leader(self, value):
+        renewed = self.keepalive()
+        if not renewed:
+            return renewed
+        try:
+            held = self.txn(self.leader_held(value), [])
+        except (urllib2.HTTPError, urllib2.URLError, ssl.SSLError, ValueError) as e:
+            logger.error("Error checking the leader lock: %s" % e)
+            return None
+        return held
+
+    def leader_held(self, value):
+        return [value_equals(self.key("/leader"), value),
+                {"key": self.key("/leader"), "target": "LEASE", "result": "EQUAL", "lease": self.lease.id}]
+
+    def request_switchover(self, leader, member, ttl):
+        lease = self.post("/lease/grant", {"TTL": ttl})["ID"]
+        put = self.put_request("/switchover", json.dumps({"leader": leader, "member": member}, sort_keys=True), lease)
+        self.post("/kv/put", put["request_put"])
+
+class Lease:
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.id = None
+        self.kept_alive_at = None
+        self.lock = threading.RLock()
+
+def encode(value):
+    return base64.b64encode(value)
+
+def decode(value):
+    return base64.b64decode(value)
+
+# the first key after every key that starts with prefix
+def prefix_end(prefix):
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+def value_equals(key, value):
+    return {"key": key, "target": "VALUE", "result": "EQUAL", "value": encode(value)}
+
+def compare_failed(path):
+    return urllib2.HTTPError(path, 412, "Compare failed", None, StringIO(path))
+
+# the gateway ends every streamed message with a newline
+def read_line(response):
+    line = []
+    while True:
+        char = response.read(1)
+        if not char:
+            raise urllib2.URLError("watch stream closed")
+        if char == "\n":
+            return "".join(line)
+        line.append(char)
@@ -0,0 +1,412 @@
+import threading, time, json, socket, base64
+import logging
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from urlparse import urlparse, parse_qs
+
+logger = logging.getLogger(__name__)
+
+# An in-process stand-in for the etcd v2 keys API, good enough to run governors against:
+# ttl, prevExist, prevValue, recursive reads and wait/waitIndex watches. The same keys are also
+# served through the subset of the v3 JSON gateway that api: v3 uses: leases, range, put,
+# deleterange, txn on values and create revisions, and watches. Every listener can be slowed
+# down, paused or cut off on its own, so one member can be partitioned from etcd.
+
+class EtcdError(Exception):
+    def __init__(self, status, code, message, cause):
+        self.status = status
+        self.body = {"errorCode": code, "message": message, "cause": cause}
+
+class Store:
+    def __init__(self):
+        self.nodes = {}
+        self.index = 1
+        self.history = []
+        self.leases = {}
+        self.condition = threading.Condition()
+        self.reaper = threading.Thread(target=self.reap, name="fake etcd ttl")
+        self.reaper.daemon = True
+        self.reaper.start()
+
+    def event(self, action, key, node, previous):
+        self.index += 1
+        event = {"action": action, "node": {"key": key, "modifiedIndex": self.index}}
+        if node is not None:
+            node["modifiedIndex"] = self.index
+            event["node"] = self.render(node)
+        if previous is not None:
+            event["prevNode"] = self.render(previous)
+        self.history.append(event)
+        del self.history[:-1000]
+        self.condition.notify_all()
+        return event
+
+    def render(self, node):
+        rendered = {"key": node["key"], "modifiedIndex": node["modifiedIndex"], "createdIndex": node["createdIndex"]}
+        if node.get("dir"):
+            rendered["dir"] = True
+        else:
+            rendered["value"] = node["value"]
+        if node.get("expiration") is not None:
+            rendered["ttl"] = max(1, int(round(node["expiration"] - time.time())))
+        return rendered
+
+    def reap(self):
+        while True:
+            with self.condition:
+                now = time.time()
+                for lease, expiration in self.leases.items():
+                    if expiration[1] <= now:
+                        del self.leases[lease]
+                for key, node in self.nodes.items():
+                    expired = node.get("expiration") is not None and node["expiration"] <= now
+                    if expired or (node.get("lease") is not None and node["lease"] not in self.leases):
+                        del self.nodes[key]
+                        self.event("expire", key, None, node)
+            time.sleep(0.1)
+
+    def get(self, key, recursive):
+        with self.condition:
+            return self.read(key, recursive), self.index
+
+    def read(self, key, recursive):
+        key = key.rstrip("/") or "/"
+        if key in self.nodes:
+            return {"action": "get", "node": self.render(self.nodes[key])}
+
+        prefix = key == "/" and "/" or key + "/"
+        children = [k for k in self.nodes.keys() if k.startswith(prefix)]
+        if not children:
+            raise EtcdError(404, 100, "Key not found", key)
+        return {"action": "get", "node": self.directory(key, sorted(children), recursive)}
+
+    def directory(self, key, descendants, recursive):
+        prefix = key == "/" and "/" or key + "/"
+        node = {"key": key, "dir": True, "nodes": []}
+        seen = set()
+        for child in descendants:
+            name = child[len(prefix):].split("/")[0]
+            if name in seen:
+                continue
+            seen.add(name)
+            path = prefix + name
+            if path in self.nodes:
+                node["nodes"].append(self.render(self.nodes[path]))
+            elif recursive:
+                node["nodes"].append(self.directory(path, [c for c in descendants if c.startswith(path + "/")], True))
+            else:
+                node["nodes"].append({"key": path, "dir": True})
+        return node
+
+    def set(self, key, value, ttl=None, prev_exist=None, prev_value=None, lease=None):
+        with self.condition:
+            previous = self.nodes.get(key)
+            if prev_exist is False and previous is not None:
+                raise EtcdError(412, 105, "Key already exists", key)
+            if (prev_exist is True or prev_value is not None) and previous is None:
+                raise EtcdError(404, 100, "Key not found", key)
+            if prev_value is not None and previous["value"] != prev_value:
+                raise EtcdError(412, 101, "Compare failed", "[%s != %s]" % (prev_value, previous["value"]))
+
+            node = {"key": key, "value": value, "createdIndex": previous and previous["createdIndex"] or self.index + 1,
+                    "expiration": ttl and time.time() + float(ttl) or None, "lease": lease}
+            self.nodes[key] = node
+            action = prev_value is not None and "compareAndSwap" or previous is None and "create" or "set"
+            return self.event(action, key, node, previous), self.index
+
+    def delete(self, key, prev_value=None):
+        with self.condition:
+            previous = self.nodes.get(key)
+            if previous is None:
+                raise EtcdError(404, 100, "Key not found", key)
+            if prev_value is not None and previous["value"] != prev_value:
+                raise EtcdError(412, 101, "Compare failed", "[%s != %s]" % (prev_value, previous["value"]))
+            del self.nodes[key]
+            return self.event(prev_value is not None and "compareAndDelete" or "delete", key, None, previous), self.index
+
+    # the nodes from key up to, but not including, range_end
+    def range(self, key, range_end):
+        with self.condition:
+            return [self.nodes[k] for k in sorted(self.nodes.keys()) if k == key or (range_end and key <= k < range_end)], self.index
+
+    def grant(self, ttl):
+        with self.condition:
+            lease = len(self.leases) and max(self.leases.keys()) + 1 or int(time.time() * 1000)
+            self.leases[lease] = (int(ttl), time.time() + int(ttl))
+            return lease
+
+    # the lease's ttl, 0 once it has expired
+    def keepalive(self, lease):
+        with self.condition:
+            if lease not in self.leases:
+                return 0
+            ttl = self.leases[lease][0]
+            self.leases[lease] = (ttl, time.time() + ttl)
+            return ttl
+
+    # without a range_end, key and everything below it when recursive
+    def wait(self, key, index, recursive, timeout, range_end=None):
+        deadline = time.time() + timeout
+        with self.condition:
+            while True:
+                if len(self.history) >= 1000 and index < self.history[0]["node"]["modifiedIndex"]:
+                    raise EtcdError(400, 401, "The event in requested index is outdated and cleared", key)
+                for event in self.history:
+                    event_key = event["node"]["key"]
+                    if range_end is not None:
+                        matches = key <= event_key < range_end
+                    else:
+                        matches = event_key == key or (recursive and event_key.startswith(key.rstrip("/") + "/"))
+                    if event["node"]["modifiedIndex"] >= index and matches:
+                        return event, self.index
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None, self.index
+                self.condition.wait(min(remaining, 1))
+
+class Listener(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, etcd, name):
+        HTTPServer.__init__(self, ("127.0.0.1", 0), Handler)
+        self.etcd = etcd
+        self.name = name
+        self.latency = 0
+        self.paused = False
+        self.partitioned = False
+
+    def url(self):
+        return "http://127.0.0.1:%s" % self.server_address[1]
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def faults(self):
+        server = self.server
+        if server.partitioned or server.etcd.partitioned:
+            self.close_connection = 1
+            self.connection.shutdown(socket.SHUT_RDWR)
+            return False
+        while server.paused or server.etcd.paused:
+            time.sleep(0.05)
+        if server.latency or server.etcd.latency:
+            time.sleep(server.latency + server.etcd.latency)
+        return True
+
+    def reply(self, status, body, index):
+        data = json.dumps(body)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("X-Etcd-Index", str(index))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def handle_request(self, action):
+        if not self.faults():
+            return
+        url = urlparse(self.path)
+        store = self.server.etcd.store
+        if url.path == "/v2/members":
+            return self.reply(200, {"members": [{"name": "fake", "clientURLs": [self.server.url()]}]}, store.index)
+        if not url.path.startswith("/v2/keys"):
+            return self.reply(404, {"message": "Not found"}, store.index)
+
+        key = url.path[len("/v2/keys"):] or "/"
+        try:
+            body, index = action(store, key, parse_qs(url.query))
+            self.reply(body.get("action") in ("create",) and 201 or 200, body, index)
+        except EtcdError as e:
+            self.reply(e.status, dict(e.body, index=store.index), store.index)
+
+    def do_GET(self):
+        def get(store, key, query):
+            recursive = query.get("recursive", ["false"])[0] == "true"
+            if query.get("wait", ["false"])[0] == "true":
+                index = int(query.get("waitIndex", [store.index + 1])[0])
+                event, current = store.wait(key, index, recursive, 300)
+                if event is None:
+                    raise EtcdError(408, 0, "Watch timed out", key)
+                return event, current
+            return store.get(key, recursive)
+        self.handle_request(get)
+
+    def form(self):
+        length = int(self.headers.getheader("Content-Length") or 0)
+        data = parse_qs(self.rfile.read(length)) if length else {}
+        return dict([(k, v[0]) for k, v in data.items()])
+
+    def do_PUT(self):
+        data = self.form()
+        def put(store, key, query):
+            data.update(dict([(k, v[0]) for k, v in query.items()]))
+            prev_exist = data.get("prevExist")
+            if prev_exist is not None:
+                prev_exist = prev_exist.lower() == "true"
+            return store.set(key, data.get("value", ""), data.get("ttl") or None, prev_exist, data.get("prevValue"))
+        self.handle_request(put)
+
+    def do_DELETE(self):
+        def delete(store, key, query):
+            return store.delete(key, query.get("prevValue", [None])[0])
+        self.handle_request(delete)
+
+    def do_POST(self):
+        if not self.faults():
+            return
+        length = int(self.headers.getheader("Content-Length") or 0)
+        request = json.loads(self.rfile.read(length) or "{}")
+        store = self.server.etcd.store
+        path = urlparse(self.path).path
+        if path == "/v3/watch":
+            return self.watch(store, request["create_request"])
+        v3 = V3(store)
+        handler = {"/v3/kv/range": v3.range, "/v3/kv/put": v3.put, "/v3/kv/deleterange": v3.delete_range, "/v3/kv/txn": v3.txn,
+                   "/v3/lease/grant": v3.grant, "/v3/lease/keepalive": v3.keepalive}.get(path)
+        if handler is None:
+            return self.reply(404, {"message": "Not found"}, store.index)
+        try:
+            with store.condition:
+                body = handler(request)
+                body["header"] = {"revision": str(store.index)}
+        except EtcdError as e:
+            return self.reply(e.status, {"error": e.body["message"], "message": e.body["message"]}, store.index)
+        if path == "/v3/lease/keepalive":
+            body = {"result": body}
+        self.reply(200, body, store.index)
+
+    # a streamed answer: the watch is created, then the first event follows once there is one
+    def watch(self, store, request):
+        start = int(request.get("start_revision", store.index + 1))
+        self.close_connection = 1
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.wfile.write(json.dumps({"result": {"header": {"revision": str(store.index)}, "created": True}}) + "\n")
+        self.wfile.flush()
+        key, range_end = decode(request["key"]), request.get("range_end") and decode(request["range_end"])
+        try:
+            event, index = store.wait(key, start, False, 300, range_end or key + "\0")
+        except EtcdError:
+            self.wfile.write(json.dumps({"result": {"canceled": True, "compact_revision": str(store.index)}}) + "\n")
+            return
+        if event is not None:
+            self.wfile.write(json.dumps({"result": {"header": {"revision": str(index)}, "events": [V3.event(event)]}}) + "\n")
+
+# the v3 requests, on the v2 store; each runs holding the store's lock, so a txn is atomic
+class V3:
+    def __init__(self, store):
+        self.store = store
+
+    @staticmethod
+    def kv(node):
+        kv = {"key": encode(node["key"]), "create_revision": str(node.get("createdIndex", 0)), "mod_revision": str(node["modifiedIndex"])}
+        if node.get("value") is not None:
+            kv["value"] = encode(node["value"])
+        if node.get("lease") is not None:
+            kv["lease"] = str(node["lease"])
+        return kv
+
+    @staticmethod
+    def event(event):
+        converted = {"kv": V3.kv(event["node"])}
+        if event["action"] in ("delete", "compareAndDelete", "expire"):
+            converted["type"] = "DELETE"
+        if event.get("prevNode") is not None:
+            converted["prev_kv"] = V3.kv(event["prevNode"])
+        return converted
+
+    def range(self, request):
+        nodes = self.store.range(decode(request["key"]), request.get("range_end") and decode(request["range_end"]))[0]
+        body = {"count": str(len(nodes))}
+        if nodes:
+            body["kvs"] = [V3.kv(node) for node in nodes]
+        return body
+
+    def put(self, request):
+        lease = request.get("lease") and int(request["lease"]) or None
+        if lease is not None and lease not in self.store.leases:
+            raise EtcdError(404, 0, "requested lease not found", request["lease"])
+        self.store.set(decode(request["key"]), decode(request.get("value", "")), lease=lease)
+        return {}
+
+    def delete_range(self, request):
+        nodes = self.store.range(decode(request["key"]), request.get("range_end") and decode(request["range_end"]))[0]
+        for node in nodes:
+            self.store.delete(node["key"])
+        return {"deleted": str(len(nodes))}
+
+    def compare(self, compare):
+        node = self.store.nodes.get(decode(compare["key"]))
+        if compare["target"] == "VALUE":
+            actual, expected = node and encode(node["value"]), compare.get("value", "")
+        elif compare["target"] == "CREATE":
+            actual, expected = node and str(node["createdIndex"]) or "0", compare.get("create_revision", "0")
+        elif compare["target"] == "LEASE":
+            actual, expected = node and node.get("lease") is not None and str(node["lease"]) or "0", str(compare.get("lease", "0"))
+        else:
+            raise EtcdError(400, 0, "unsupported compare target", compare["target"])
+        return (actual == expected) == (compare.get("result", "EQUAL") == "EQUAL")
+
+    def txn(self, request):
+        succeeded = all([self.compare(compare) for compare in request.get("compare", [])])
+        for operation in request.get(succeeded and "success" or "failure", []):
+            if "request_put" in operation:
+                self.put(operation["request_put"])
+            elif "request_delete_range" in operation:
+                self.delete_range(operation["request_delete_range"])
+        body = {}
+        if succeeded:
+            body["succeeded"] = True
+        return body
+
+    def grant(self, request):
+        lease = self.store.grant(request["TTL"])
+        return {"ID": str(lease), "TTL": str(request["TTL"])}
+
+    def keepalive(self, request):
+        body = {"ID": str(request["ID"])}
+        ttl = self.store.keepalive(int(request["ID"]))
+        if ttl:
+            body["TTL"] = str(ttl)
+        return body
+
+def encode(value):
+    return base64.b64encode(value)
+
+def decode(value):
+    return base64.b64decode(value)
+
+class FakeEtcd:
+    def __init__(self):
+        self.store = Store()
+        self.listeners = {}
+        self.latency = 0
+        self.paused = False
+        self.partitioned = False
+
+    # one listener per client, so faults can be aimed at a single member
+    def listener(self, name):
+        if name not in self.listeners:
+            listener = Listener(self, name)
+            thread = threading.Thread(target=listener.serve_forever, name="fake etcd %s" % name)
+            thread.daemon = True
+            thread.start()
+            self.listeners[name] = listener
+        return self.listeners[name]
+
+    def value(self, key):
+        try:
+            return self.store.get(key, False)[0]["node"].get("value")
+        except EtcdError:
+            return None
+
+    def shutdown(self):
+        for listener in self.listeners.values():
+            listener.shutdown()
+            listener.server_close()
@@ -3,6 +3,7 @@ import logging
 from base64 import b64decode
 
 import helpers.errors
+from helpers.metrics import ELECTIONS, LEADER_TTL, DEMOTIONS
 
 import inspect
 
@@ -14,50 +15,156 @@ def lineno():
     return inspect.currentframe().f_back.f_lineno
 
 class Ha:
-    def __init__(self, state_handler, etcd):
+    def __init__(self, state_handler, etcd, heartbeat=None, haproxy=None):
         self.state_handler = state_handler
         self.etcd = etcd
+        self.heartbeat = heartbeat
+        self.haproxy = haproxy
+
+    def hold_lock(self, held, renewed_at=None):
+        if self.heartbeat is None:
+            return
+        if held:
+            self.heartbeat.hold()
+            if renewed_at is not None:
+                self.heartbeat.renewed(renewed_at)
+        else:
+            self.heartbeat.release()
 
     def acquire_lock(self):
-        return self.etcd.attempt_to_acquire_leader(self.state_handler.name)
+        started = time.time()
+        acquired = self.etcd.attempt_to_acquire_leader(self.state_handler.name)
+        self.hold_lock(acquired, started)
+        return acquired
 
     def update_lock(self):
-        return self.etcd.update_leader(self.state_handler)
+        started = time.time()
+        updated = self.etcd.update_leader(self.state_handler)
+        if updated:
+            # a lease lasts from its last keepalive, which need not have been this call
+            if self.etcd.lease is not None:
+                started = self.etcd.lease.kept_alive_at
+            self.hold_lock(True, started)
+        return updated
 
     def update_last_leader_operation(self):
         return self.etcd.update_last_leader_operation(self.state_handler.last_operation)
 
     def is_unlocked(self):
-        return self.etcd.leader_unlocked()
+        unlocked = self.etcd.leader_unlocked()
+        if unlocked:
+            self.hold_lock(False)
+        return unlocked
 
     def has_lock(self):
-        return self.etcd.am_i_leader(self.state_handler.name)
+        held = self.etcd.am_i_leader(self.state_handler.name)
+        if not held:
+            self.hold_lock(False)
+        return held
 
     def fetch_current_leader(self):
         return self.etcd.current_leader()
 
+    def promote(self):
+        self.state_handler.promote()
+        if self.haproxy is not None:
+            self.haproxy.promoted()
+
+    def lead(self):
+        if self.haproxy is not None:
+            self.haproxy.leading()
+
+    # clients are turned away before the primary goes
+    def demote(self, leader):
+        if self.haproxy is not None:
+            self.haproxy.demoted()
+        self.state_handler.demote(leader)
+
+    # Hand the lock to the member a switchover request names. The target must be within
+    # maximum_lag_on_failover before anything is stopped; then Postgres is shut down cleanly and
+    # the lock only released once the target has replayed the shutdown checkpoint, so that it
+    # promotes with every commit and this node can follow it without a rewind.
+    def switchover(self, request):
+        name = self.state_handler.name
+        if request.get("leader") != name:
+            logger.info("Dropping switchover request for former leader %s" % request.get("leader"))
+            self.etcd.clear_switchover()
+            return "dropped a switchover request addressed to %s" % request.get("leader")
+
+        target = None
+        for member in self.etcd.members() or []:
+            if member["hostname"] == request.get("member"):
+                target = member
+        if target is None or target.get("nofailover"):
+            logger.warning("Cannot switch over to %s: not a member that may be promoted" % request.get("member"))
+            self.etcd.clear_switchover()
+            return "dropped switchover request for %s" % request.get("member")
+        if self.state_handler.config.get("synchronous_mode"):
+            sync = self.etcd.sync_state()
+            if sync is not None and target["hostname"] not in sync.get("sync_standby", []):
+                return "switchover to %s waiting for it to become synchronous" % target["hostname"]
+
+        lag = self.state_handler.replication_lag().get(target["hostname"])
+        if lag is None or lag > self.state_handler.config["maximum_lag_on_failover"]:
+            return "switchover to %s waiting for it to catch up, %s bytes behind" % (target["hostname"], lag)
+
+        logger.info("Switching over to %s: shutting down" % target["hostname"])
+        if self.haproxy is not None:
+            self.haproxy.demoted()
+        if not self.state_handler.stop():
+            self.resume_as_leader()
+            return "switchover to %s aborted, postgresql did not shut down" % target["hostname"]
+        location = self.state_handler.checkpoint_location()
+        if not self.state_handler.wait_for_replay(target, location, self.etcd.ttl / 3.0):
+            logger.warning("%s did not replay up to %s in time, staying leader" % (target["hostname"], location))
+            self.resume_as_leader()
+            self.etcd.clear_switchover()
+            return "switchover to %s aborted, it did not catch up in time" % target["hostname"]
+
+        DEMOTIONS.inc()
+        self.state_handler.write_recovery_conf(target)
+        self.state_handler.save_state(target)
+        if self.etcd.release_leader(name):
+            self.hold_lock(False)
+        self.state_handler.start()
+        return "switched over to %s" % target["hostname"]
+
+    def resume_as_leader(self):
+        self.state_handler.start()
+        if self.haproxy is not None:
+            self.haproxy.promoted()
+
     def run_cycle(self):
+        snapshot = self.etcd.refresh_snapshot()
+        if snapshot is not None:
+            leader = snapshot.get("/leader")
+            LEADER_TTL.set(leader.get("ttl", 0) if leader is not None else 0, scope=self.etcd.scope)
+        self.state_handler.reset_status()
         try:
             if self.state_handler.is_healthy():
                 if self.is_unlocked():
                     logging.info("Leader is unlocked - starting election")
+                    ELECTIONS.inc()
                     if self.state_handler.is_healthiest_node(self.etcd):
                         if self.acquire_lock():
+                            if self.etcd.switchover() is not None:
+                                self.etcd.clear_switchover()
                             if not self.state_handler.is_leader():
-                                self.state_handler.promote()
+                                self.promote()
                                 return "promoted self to leader by acquiring session lock"
 
+                            self.lead()
                             return "acquired session lock as a leader"
                         else:
                             if self.state_handler.is_leader():
-                                self.state_handler.demote(self.fetch_current_leader())
+                                self.demote(self.fetch_current_leader())
                                 return "demoted self due after trying and failing to obtain lock"
                             else:
                                 self.state_handler.follow_the_leader(self.fetch_current_leader())
                                 return "following new leader after trying and failing to obtain lock"
                     else:
                         if self.state_handler.is_leader():
-                            self.state_handler.demote(self.fetch_current_leader())
+                            self.demote(self.fetch_current_leader())
                             return "demoting self because i am not the healthiest node"
                         elif self.fetch_current_leader() is None:
                             self.state_handler.follow_no_leader()
@@ -71,19 +178,24 @@ class Ha:
                         self.update_lock()
 
                         if not self.state_handler.is_leader():
-                            self.state_handler.promote()
+                            self.promote()
                             return "promoted self to leader because i had the session lock"
-                        else:
-                            return "no action.  i am the leader with the lock"
+
+                        request = self.etcd.switchover()
+                        if request is not None and request.get("member") != self.state_handler.name:
+                            return self.switchover(request)
+                        self.lead()
+                        return "no action.  i am the leader with the lock"
                     else:
                         logger.info("does not have lock")
                         if self.state_handler.is_leader():
-                            self.state_handler.demote(self.fetch_current_leader())
+                            self.demote(self.fetch_current_leader())
                             return "demoting self because i do not have the lock and i was a leader"
                         else:
                             self.state_handler.follow_the_leader(self.fetch_current_leader())
                             return "no action.  i am a secondary and i am following a leader"
             else:
+                self.hold_lock(False)
                 if not self.state_handler.is_running():
                     self.state_handler.start()
                     return "postgresql was stopped.  starting again."
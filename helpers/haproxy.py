@@ -0,0 +1,93 @@
+import socket
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Pushes role changes into HAProxy through its runtime API, so that traffic moves at promotion
+# and demotion instead of after the next few health checks. The checks stay configured and keep
+# correcting whatever a lost command left behind. Commands that fail are logged, never raised.
+class HAProxyRuntime:
+    def __init__(self, config, listen):
+        sockets = config["socket"]
+        self.sockets = sockets if isinstance(sockets, list) else [sockets]
+        self.backend = config.get("backend", "bk_db")
+        # haproxy.cfg names servers postgresql_<host>_<port>
+        self.server = config.get("server", "postgresql_%s" % listen.replace(":", "_"))
+        self.demoted_state = config.get("demoted_state", "drain")
+        self.timeout = config.get("timeout", 1)
+
+    # a unix socket path, or host:port for a stats socket bound to TCP
+    def connect(self, address):
+        if address.startswith("/"):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            host, port = address.rsplit(":", 1)
+            address = (host, int(port))
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(address)
+        return sock
+
+    # one connection per batch; HAProxy runs ';'-separated commands in order and closes
+    def execute(self, address, commands):
+        sock = self.connect(address)
+        try:
+            sock.sendall(";".join(commands) + "\n")
+            output = []
+            while True:
+                data = sock.recv(4096)
+                if not data:
+                    break
+                output.append(data)
+            return "".join(output)
+        finally:
+            sock.close()
+
+    def run(self, commands):
+        for address in self.sockets:
+            try:
+                self.run_on(address, commands)
+            except (socket.error, socket.timeout, ValueError) as e:
+                logger.warning("Could not reach HAProxy at %s: %s" % (address, e))
+
+    def run_on(self, address, commands):
+        output = self.execute(address, commands).strip()
+        if output:
+            logger.warning("HAProxy at %s answered %s: %s" % (address, "; ".join(commands), output))
+
+    def servers(self, address):
+        # "show servers state" starts with a format version and a header, srv_name is the fourth column
+        lines = self.execute(address, ["show servers state %s" % self.backend]).splitlines()
+        return [line.split()[3] for line in lines[1:] if line.strip() and not line.startswith("#")]
+
+    def server_down(self, server):
+        path = "%s/%s" % (self.backend, server)
+        return ["set server %s state %s" % (path, self.demoted_state),
+                "set server %s health down" % path,
+                "shutdown sessions server %s" % path]
+
+    def server_up(self):
+        path = "%s/%s" % (self.backend, self.server)
+        return ["set server %s state ready" % path, "set server %s health up" % path]
+
+    # this member now takes the writes: its server is ready and every other server in the
+    # backend stops taking them, including the sessions still open on an old primary
+    def promoted(self):
+        for address in self.sockets:
+            try:
+                commands = self.server_up()
+                for server in self.servers(address):
+                    if server != self.server:
+                        commands.extend(self.server_down(server))
+                self.run_on(address, commands)
+            except (socket.error, socket.timeout, ValueError, IndexError) as e:
+                logger.warning("Could not reach HAProxy at %s: %s" % (address, e))
+
+    # health checks never clear an admin state such as drain, so the leader says it again every
+    # cycle in case the push at promotion was lost to a reload or a socket that was down
+    def leading(self):
+        self.run(self.server_up())
+
+    # called before Postgres stops taking writes, so that clients go nowhere rather than to a standby
+    def demoted(self):
+        self.run(self.server_down(self.server))
@@ -0,0 +1,65 @@
+import threading, time
+import logging
+
+logger = logging.getLogger(__name__)
+
+class LeaderHeartbeat(threading.Thread):
+    def __init__(self, etcd, state_handler, wakeup=None):
+        threading.Thread.__init__(self, name="leader heartbeat")
+        self.daemon = True
+        self.etcd = etcd
+        self.state_handler = state_handler
+        self.wakeup = wakeup
+        self.interval = etcd.ttl / 3.0
+        self.held_at = None
+        self.renewed_at = None
+        self.lock = threading.Lock()
+
+    # called by the HA loop every cycle it holds the lock
+    def hold(self):
+        with self.lock:
+            self.held_at = time.time()
+
+    def release(self):
+        with self.lock:
+            self.held_at = None
+
+    # the lease: when a write to the leader key last succeeded, counted from when it was sent
+    def renewed(self, at):
+        with self.lock:
+            if self.renewed_at is None or at > self.renewed_at:
+                self.renewed_at = at
+
+    def lease_expires(self):
+        with self.lock:
+            if self.renewed_at is None:
+                return None
+            return self.renewed_at + self.etcd.ttl
+
+    # after fencing there is no lease left to watch until the lock is written again
+    def expire(self):
+        with self.lock:
+            self.renewed_at = None
+
+    # renew while the HA loop says we hold the lock, but not on behalf of a loop that has been
+    # gone for two ttls or a postmaster that has died
+    def should_renew(self):
+        with self.lock:
+            held_at = self.held_at
+        if held_at is None or time.time() - held_at > 2 * self.etcd.ttl:
+            return False
+        return self.state_handler.is_running()
+
+    def run(self):
+        while True:
+            started = time.time()
+            if self.should_renew():
+                renewed = self.etcd.renew_leader(self.state_handler.name)
+                if renewed:
+                    self.renewed(started)
+                elif renewed is False:
+                    logger.warning("Lost the leader lock, waking up HA loop")
+                    self.release()
+                    if self.wakeup is not None:
+                        self.wakeup.set()
+            time.sleep(max(0, self.interval - (time.time() - started)))
@@ -0,0 +1,131 @@
+import threading, time
+from contextlib import contextmanager
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+def format_labels(names, values, extra=None):
+    pairs = zip(names, values)
+    if extra is not None:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{%s}" % ",".join(['%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"')) for name, value in pairs])
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def key(self, labels):
+        return tuple([labels[name] for name in self.labels])
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.description), "# TYPE %s %s" % (self.name, self.kind)]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines += self.render_value(key, value)
+        return lines
+
+    def render_value(self, key, value):
+        return ["%s%s %s" % (self.name, format_labels(self.labels, key), value)]
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+    # drop label sets that are no longer current, e.g. members that left; with labels,
+    # only among the label sets that carry those values
+    def retain(self, keep, **labels):
+        positions = [(self.labels.index(name), value) for name, value in labels.items()]
+        with self.lock:
+            for key in self.values.keys():
+                if key not in keep and all([key[i] == value for i, value in positions]):
+                    del self.values[key]
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, description, labels=(), buckets=BUCKETS):
+        Metric.__init__(self, name, description, labels)
+        self.buckets = buckets
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            counts, total, count = self.values.get(key, ([0] * len(self.buckets), 0.0, 0))
+            counts = [c + (value <= bound and 1 or 0) for c, bound in zip(counts, self.buckets)]
+            self.values[key] = (counts, total + value, count + 1)
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - started, **labels)
+
+    def render_value(self, key, value):
+        counts, total, count = value
+        lines = []
+        for bound, c in zip(self.buckets, counts):
+            lines.append("%s_bucket%s %s" % (self.name, format_labels(self.labels, key, ("le", bound)), c))
+        lines.append("%s_bucket%s %s" % (self.name, format_labels(self.labels, key, ("le", "+Inf")), count))
+        lines.append("%s_sum%s %s" % (self.name, format_labels(self.labels, key), total))
+        lines.append("%s_count%s %s" % (self.name, format_labels(self.labels, key), count))
+        return lines
+
+def timed(histogram, **labels):
+    def decorator(function):
+        def wrapper(*args, **kwargs):
+            with histogram.time(**labels):
+                return function(*args, **kwargs)
+        wrapper.__name__ = function.__name__
+        return wrapper
+    return decorator
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    # Prometheus text exposition format
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+REGISTRY = Registry()
+
+CYCLE_DURATION = REGISTRY.register(Histogram("governor_cycle_duration_seconds", "Time spent in one HA cycle."))
+ETCD_REQUEST_DURATION = REGISTRY.register(Histogram("governor_etcd_request_duration_seconds", "Time spent on an etcd request.", ["method"]))
+POSTGRES_QUERY_DURATION = REGISTRY.register(Histogram("governor_postgres_query_duration_seconds", "Time spent on a query against the local Postgres."))
+POSTGRES_OPERATION_DURATION = REGISTRY.register(Histogram("governor_postgres_operation_duration_seconds", "Time spent starting, stopping, restarting, reloading, promoting, rewinding or cloning Postgres.", ["operation"]))
+ELECTIONS = REGISTRY.register(Counter("governor_elections_total", "Leader elections this node took part in."))
+PROMOTIONS = REGISTRY.register(Counter("governor_promotions_total", "Times this node was promoted to leader."))
+DEMOTIONS = REGISTRY.register(Counter("governor_demotions_total", "Times this node was demoted from leader."))
+RESTARTS = REGISTRY.register(Counter("governor_restarts_total", "Times Postgres was restarted."))
+REWINDS = REGISTRY.register(Counter("governor_rewinds_total", "Times a diverged old leader rejoined, by pg_rewind or, when that failed, a new base backup.", ["result"]))
+FENCES = REGISTRY.register(Counter("governor_fences_total", "Times Postgres was fenced because the leader lease ran out.", ["mode"]))
+REPLICATION_LAG = REGISTRY.register(Gauge("governor_replication_lag_bytes", "Bytes each streaming member's replay is behind the leader, as seen from the leader.", ["scope", "member"]))
+ORPHANED_SLOT_WAL = REGISTRY.register(Gauge("governor_orphaned_slot_retained_bytes", "Bytes of WAL the leader retains for each replication slot that has no member in etcd.", ["scope", "slot"]))
+LEADER_TTL = REGISTRY.register(Gauge("governor_leader_ttl_seconds", "Seconds left on the leader key at the start of the last cycle.", ["scope"]))
@@ -1,14 +1,29 @@
-import os, psycopg2, re, time
+import os, sys, psycopg2, re, time, json, threading, signal, errno, subprocess, shutil
 import logging
 
 from urlparse import urlparse
+from helpers.basebackup import BaseBackup
+from helpers.metrics import timed, POSTGRES_QUERY_DURATION, POSTGRES_OPERATION_DURATION, PROMOTIONS, DEMOTIONS, RESTARTS, REWINDS
 
 
 logger = logging.getLogger(__name__)
 
+RECOVERY_SETTINGS = ["standby_mode", "primary_conninfo", "primary_slot_name", "recovery_target_timeline"]
+
+# server version from which a change to the setting takes effect on reload
+RELOADABLE_RECOVERY_SETTINGS = {
+    "primary_conninfo": 130000,
+    "primary_slot_name": 130000,
+    "restore_command": 140000,
+    "archive_cleanup_command": 120000,
+    "recovery_end_command": 120000,
+    "recovery_min_apply_delay": 120000,
+    "promote_trigger_file": 120000,
+}
+
 class Postgresql:
 
-    def __init__(self, config):
+    def __init__(self, config, retry_timeout=25):
         self.name = config["name"]
         self.host, self.port = config["listen"].split(":")
         self.data_dir = config["data_dir"]
@@ -20,10 +35,30 @@ class Postgresql:
         self.connection_string = "postgres://%s:%s@%s:%s/postgres" % (self.replication["username"], self.replication["password"], self.host, self.port)
 
         self.conn = None
+        self.status = None
+        self.retry_timeout = retry_timeout
+
+        self.member_probe_timeout = config.get("member_probe_timeout", 3)
+        self.member_connections = {}
+        self.member_lock = threading.Lock()
+
+        self.slot_members = None
+        # slots without a member: the WAL each retains, and since when governor's own have also been inactive
+        self.orphaned_slots = {}
+        self.orphaned_since = {}
+        self.orphaned_slot_grace = config.get("orphaned_slot_grace", 300)
+
+        self.postmaster = None
+        self.conf_file_cache = {}
+        self.synchronous_standbys = None
+
+        # outside the data dir, which a base backup wipes
+        self.state_file = config.get("state_file", "%s.state" % self.data_dir.rstrip("/"))
+        self.state = None
 
     def cursor(self):
         if not self.cursor_holder:
-            self.conn = psycopg2.connect(self.local_connection_string())
+            self.conn = psycopg2.connect(self.local_connection_string(), connect_timeout=max(2, int(self.retry_timeout)))
             self.conn.autocommit = True
             self.cursor_holder = self.conn.cursor()
 
@@ -46,57 +81,173 @@ class Postgresql:
         except Exception as e:
             logger.error("Error disconnecting: %s" % e)
 
-    def query(self, sql):
-        max_attempts = 0
+    def query(self, sql, params=None):
+        deadline = time.time() + self.retry_timeout
+        retry_wait = 0.5
         while True:
             try:
-                self.cursor().execute(sql)
+                with POSTGRES_QUERY_DURATION.time():
+                    cursor = self.cursor()
+                    cursor.execute(wal_names(sql, self.conn.server_version), params)
                 break
             except psycopg2.OperationalError as e:
                 if self.conn:
                     self.disconnect()
                 self.cursor_holder = None
-                if max_attempts > 4:
+                if time.time() + retry_wait > deadline:
                     raise e
-                max_attempts += 1
-                time.sleep(5)
+                time.sleep(retry_wait)
+                retry_wait = min(retry_wait * 2, 5)
         return self.cursor()
 
     def data_directory_empty(self):
         return not os.path.exists(self.data_dir) or os.listdir(self.data_dir) == []
 
     def initialize(self):
-        if os.system("initdb %s" % self.initdb_options()) == 0:
+        if subprocess.call(self.initdb_options()) == 0:
             # start Postgres without options to setup replication user indepedent of other system settings
-            os.system("pg_ctl start -w -D %s -o '%s'" % (self.data_dir, self.server_options()))
+            self.start()
             self.create_replication_user()
-            os.system("pg_ctl stop -w -m fast -D %s" % self.data_dir)
+            self.stop()
             self.write_pg_hba()
 
             return True
 
         return False
 
-    def sync_from_leader(self, leader):
+    @timed(POSTGRES_OPERATION_DURATION, operation="basebackup")
+    def sync_from_leader(self, leader, progress=None):
         leader = urlparse(leader["address"])
 
-        f = open("./pgpass", "w")
+        # one per data dir, so members cloning at the same time from one process do not share it
+        pgpass = "%s.pgpass" % self.data_dir.rstrip("/")
+        f = open(pgpass, "w")
         f.write("%(hostname)s:%(port)s:*:%(username)s:%(password)s\n" %
                 {"hostname": leader.hostname, "port": leader.port, "username": leader.username, "password": leader.password})
         f.close()
 
-        os.system("chmod 600 pgpass")
+        os.chmod(pgpass, 0600)
+
+        # pg_basebackup cannot resume, so a retry starts from an empty directory
+        if not self.data_directory_empty():
+            logger.info("Removing partial data directory %s" % self.data_dir)
+            shutil.rmtree(self.data_dir)
+
+        env = dict(os.environ)
+        env["PGPASSFILE"] = pgpass
+        return BaseBackup(self.basebackup_options(leader), env, progress=progress).run()
+
+    def basebackup_options(self, leader):
+        options = [self.binary("pg_basebackup"), "-R", "-D", self.data_dir, "--host=%s" % leader.hostname,
+                   "--port=%s" % leader.port, "-U", leader.username, "--progress", "--verbose"]
+        basebackup = self.config.get("basebackup", {})
+
+        # with a restore_command the new replica replays from the archive, so only the
+        # data files come from the leader
+        wal_method = basebackup.get("wal_method")
+        if wal_method is None:
+            wal_method = "none" if "restore_command" in self.config.get("recovery_conf", {}) else "stream"
+        if wal_method != "none":
+            options += ["-X", wal_method]
+        elif self.basebackup_version() >= 100000:
+            options += ["-X", "none"]
+
+        if "max_rate" in basebackup:
+            options.append("--max-rate=%s" % basebackup["max_rate"])
+        if "compress" in basebackup:
+            options.append("--compress=%s" % basebackup["compress"])
+        if "checkpoint" in basebackup:
+            options.append("--checkpoint=%s" % basebackup["checkpoint"])
+        return options
 
-        return os.system("PGPASSFILE=pgpass pg_basebackup -R -D %(data_dir)s --host=%(host)s --port=%(port)s -U %(username)s" %
-                {"data_dir": self.data_dir, "host": leader.hostname, "port": leader.port, "username": leader.username}) == 0
+    # settings that can only make every clone fail are refused at startup instead. A clone is a
+    # plain-format backup, which pg_basebackup compresses from 15 on, and only on the server
+    def check_config(self):
+        basebackup = self.config.get("basebackup", {})
+        if "compress" not in basebackup:
+            return
+        if not str(basebackup["compress"]).startswith("server-"):
+            raise ValueError("postgresql.basebackup.compress must name a server-side method such as server-gzip:5, "
+                             "pg_basebackup only compresses tar-format backups on the client")
+        if self.basebackup_version() < 150000:
+            raise ValueError("postgresql.basebackup.compress needs pg_basebackup 15 or later to compress a plain-format clone")
+
+    def basebackup_version(self):
+        output = subprocess.Popen([self.binary("pg_basebackup"), "--version"], stdout=subprocess.PIPE).communicate()[0]
+        major = re.search(r"(\d+)(?:\.(\d+))?", output)
+        if int(major.group(1)) >= 10:
+            return int(major.group(1)) * 10000
+        return int(major.group(1)) * 10000 + int(major.group(2) or 0) * 100
+
+    # recovery state and WAL positions, read in one round trip and reused until reset_status()
+    def node_status(self):
+        if self.status is None:
+            row = self.query("""SELECT pg_is_in_recovery(),
+                CASE WHEN pg_is_in_recovery() THEN NULL ELSE pg_current_xlog_location() - '0/0'::pg_lsn END,
+                pg_last_xlog_receive_location() - '0/0'::pg_lsn,
+                pg_last_xlog_replay_location() - '0/0'::pg_lsn,
+                CASE WHEN pg_is_in_recovery() THEN NULL ELSE ('x' || substr(pg_xlogfile_name(pg_current_xlog_location()), 1, 8))::bit(32)::int END,
+                EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp());""").fetchone()
+            self.status = {
+                "in_recovery": row[0],
+                "current_location": row[1],
+                "receive_location": row[2],
+                "replay_location": row[3],
+                "timeline": self.standby_timeline() if row[0] else row[4],
+                "replay_lag": row[2] - row[3] if row[2] is not None and row[3] is not None else None,
+                "replay_delay": row[5],
+            }
+        return self.status
+
+    # the timeline a standby receives, or else last replayed a checkpoint on; the functions and
+    # the view it needs are new in 9.6, and names are resolved even in a CASE branch never taken
+    def standby_timeline(self):
+        if self.server_version() < 90600:
+            return None
+        return self.query("SELECT COALESCE(max(received_tli), (pg_control_checkpoint()).timeline_id) FROM pg_stat_wal_receiver;").fetchone()[0]
+
+    def reset_status(self):
+        self.status = None
 
     def is_leader(self):
-        return not self.query("SELECT pg_is_in_recovery();").fetchone()[0]
+        return not self.node_status()["in_recovery"]
+
+    def binary(self, name):
+        if "bin_dir" in self.config:
+            return os.path.join(self.config["bin_dir"], name)
+        return name
+
+    def postmaster_pid(self):
+        # reap our own postmaster first, a zombie still answers kill(pid, 0)
+        if self.postmaster is not None and self.postmaster.poll() is not None:
+            self.postmaster = None
+
+        try:
+            f = open("%s/postmaster.pid" % self.data_dir)
+            pid = int(f.readline().strip())
+            f.close()
+        except (IOError, ValueError):
+            return None
+
+        try:
+            os.kill(pid, 0)
+        except OSError as e:
+            if e.errno != errno.EPERM:
+                return None
+        return pid
 
     def is_running(self):
-        return os.system("pg_ctl status -D %s > /dev/null" % self.data_dir) == 0
+        return self.postmaster_pid() is not None
+
+    def signal(self, signum):
+        pid = self.postmaster_pid()
+        if pid is None:
+            return False
+        os.kill(pid, signum)
+        return True
 
-    def start(self):
+    @timed(POSTGRES_OPERATION_DURATION, operation="start")
+    def start(self, timeout=60):
         if self.is_running():
             logger.error("Cannot start PostgreSQL because one is already running.")
             return False
@@ -106,28 +257,68 @@ class Postgresql:
             os.remove(pid_path)
             logger.info("Removed %s" % pid_path)
 
-        return os.system("pg_ctl start -w -D %s -o '%s'" % (self.data_dir, self.server_options())) == 0
+        self.reset_status()
+        # own session, so a ^C aimed at the governor does not reach postgres
+        self.postmaster = subprocess.Popen([self.binary("postgres"), "-D", self.data_dir] + self.server_options(), preexec_fn=os.setsid, close_fds=True)
 
-    def stop(self):
-        return os.system("pg_ctl stop -w -D %s -m fast -w" % self.data_dir) != 0
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.postmaster is None or self.postmaster.poll() is not None:
+                logger.error("PostgreSQL exited during startup")
+                self.postmaster = None
+                return False
+            try:
+                psycopg2.connect(self.local_connection_string()).close()
+                return True
+            except psycopg2.OperationalError:
+                time.sleep(0.5)
+        logger.warning("PostgreSQL is not accepting connections after %ss" % timeout)
+        return False
 
+    @timed(POSTGRES_OPERATION_DURATION, operation="stop")
+    def stop(self, timeout=60):
+        self.reset_status()
+        self.drop_connection()
+        if not self.signal(signal.SIGINT):
+            return True
+
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if not self.is_running():
+                return True
+            time.sleep(0.2)
+        logger.error("PostgreSQL did not shut down within %ss" % timeout)
+        return False
+
+    @timed(POSTGRES_OPERATION_DURATION, operation="reload")
     def reload(self):
-        return os.system("pg_ctl reload -w -D %s" % self.data_dir) == 0
+        return self.signal(signal.SIGHUP)
 
+    @timed(POSTGRES_OPERATION_DURATION, operation="restart")
     def restart(self):
-        return os.system("pg_ctl restart -w -D %s -m fast" % self.data_dir) == 0
+        RESTARTS.inc()
+        self.reset_status()
+        return self.stop() and self.start()
+
+    def drop_connection(self):
+        if self.conn:
+            self.disconnect()
+        self.conn = None
+        self.cursor_holder = None
 
     def server_options(self):
-        options = "-c listen_addresses=%s -c port=%s" % (self.host, self.port)
+        options = ["-c", "listen_addresses=%s" % self.host, "-c", "port=%s" % self.port]
         for setting, value in self.config["parameters"].iteritems():
-            options += " -c \"%s=%s\"" % (setting, value)
+            # on the command line it would shadow the value the sync manager keeps in postgresql.auto.conf
+            if setting == "synchronous_standby_names" and self.config.get("synchronous_mode"):
+                continue
+            options += ["-c", "%s=%s" % (setting, value)]
         return options
 
     def initdb_options(self):
-        options = "-D %s" % self.data_dir
+        options = [self.binary("initdb"), "-D", self.data_dir]
         if "initdb_parameters" in self.config:
-            for param in self.config["initdb_parameters"]:
-                options += " \"%s\"" % param
+            options += self.config["initdb_parameters"]
         return options
 
     def is_healthy(self):
@@ -141,31 +332,149 @@ class Postgresql:
         return True
 
     def is_healthiest_node(self, state_store):
+        if self.config.get("nofailover"):
+            return False
+
+        # during a switchover the election is left to its target, as long as it is a member
+        switchover = state_store.switchover()
+        if switchover is not None and switchover.get("member") != self.name:
+            if switchover.get("member") in [member["hostname"] for member in state_store.members() or []]:
+                logger.info("Leaving the election to switchover target %s" % switchover["member"])
+                return False
+
+        # with synchronous replication only a standby the old leader confirmed as synchronous
+        # is known to have every commit
+        if self.config.get("synchronous_mode"):
+            sync = state_store.sync_state()
+            if sync is not None and sync.get("leader") != self.name and self.name not in sync.get("sync_standby", []):
+                logger.info("%s is not a synchronous standby of %s" % (self.name, sync.get("leader")))
+                return False
+
+        last_leader_operation = state_store.last_leader_operation()
         # this should only happen on initialization
-        if state_store.last_leader_operation() is None:
+        if last_leader_operation is None:
             return True
 
-        if (state_store.last_leader_operation() - self.xlog_position()) > self.config["maximum_lag_on_failover"]:
+        if (last_leader_operation - self.xlog_position()) > self.config["maximum_lag_on_failover"]:
             return False
 
-        for member in state_store.members():
-            if member["hostname"] == self.name:
-                continue
-            try:
-                member_conn = psycopg2.connect(member["address"])
-                member_conn.autocommit = True
-                member_cursor = member_conn.cursor()
-                member_cursor.execute("SELECT %s - (pg_last_xlog_replay_location() - '0/000000'::pg_lsn) AS bytes;" % self.xlog_position())
-                xlog_diff = member_cursor.fetchone()[0]
-                logger.info([self.name, member["hostname"], xlog_diff])
-                if xlog_diff < 0:
-                    member_cursor.close()
-                    return False
-                member_cursor.close()
-            except psycopg2.OperationalError:
+        # the leader only releases the lock once the target has replayed its shutdown checkpoint,
+        # and the old leader, now a replica at that same position, must not outrank it
+        if switchover is not None and switchover.get("member") == self.name:
+            return True
+
+        # rank against the status the others published in etcd; the old leader and members
+        # that may not fail over are not candidates
+        mine = election_rank(self.member_status())
+        unpublished = []
+        for member in state_store.members() or []:
+            if member["hostname"] == self.name or member.get("role") == "master" or member.get("nofailover"):
                 continue
+            if "timeline" not in member:
+                unpublished.append(member)
+            elif election_rank(member) > mine:
+                logger.info("%s ranks ahead of %s: %s > %s" % (member["hostname"], self.name, election_rank(member), mine))
+                return False
+
+        # members that publish no status are asked over SQL
+        return self.probe_members(unpublished, self.xlog_position())
+
+    def probe_members(self, others, position):
+        self.prune_member_connections(others)
+
+        # probe every member at once; anyone who has not answered by the deadline is treated as unreachable
+        results = {}
+        threads = []
+        for member in others:
+            thread = threading.Thread(target=self.probe_member, args=(member, position, results))
+            thread.daemon = True
+            thread.start()
+            threads.append((member, thread))
+
+        deadline = time.time() + self.member_probe_timeout
+        for member, thread in threads:
+            thread.join(max(0, deadline - time.time()))
+            if thread.is_alive():
+                # the probe thread still owns the connection and closes it once it returns
+                logger.warning("No answer from %s within %ss" % (member["hostname"], self.member_probe_timeout))
+                self.drop_member_connection(member["hostname"], close=False)
+
+        for member, xlog_diff in results.items():
+            logger.info([self.name, member, xlog_diff])
+            if xlog_diff < 0:
+                return False
         return True
 
+    def probe_member(self, member, position, results):
+        conn = None
+        try:
+            conn = self.member_connection(member)
+            cursor = conn.cursor()
+            cursor.execute(wal_names("SELECT %s - (pg_last_xlog_replay_location() - '0/000000'::pg_lsn) AS bytes;" % position, conn.server_version))
+            xlog_diff = cursor.fetchone()[0]
+            cursor.close()
+            if xlog_diff is not None:
+                results[member["hostname"]] = xlog_diff
+        except psycopg2.Error:
+            self.drop_member_connection(member["hostname"], close=False)
+        finally:
+            with self.member_lock:
+                cached = self.member_connections.get(member["hostname"])
+            if conn is not None and (cached is None or cached[1] is not conn):
+                self.close_quietly(conn)
+
+    def member_connection(self, member):
+        with self.member_lock:
+            cached = self.member_connections.get(member["hostname"])
+        if cached is not None and cached[0] == member["address"] and not cached[1].closed:
+            return cached[1]
+
+        conn = psycopg2.connect(member["address"], connect_timeout=max(1, int(self.member_probe_timeout)),
+                                options="-c statement_timeout=%d" % (self.member_probe_timeout * 1000))
+        conn.autocommit = True
+        with self.member_lock:
+            self.member_connections[member["hostname"]] = (member["address"], conn)
+        if cached is not None:
+            self.close_quietly(cached[1])
+        return conn
+
+    def drop_member_connection(self, hostname, close=True):
+        with self.member_lock:
+            cached = self.member_connections.pop(hostname, None)
+        if cached is not None and close:
+            self.close_quietly(cached[1])
+
+    def prune_member_connections(self, members):
+        current = set([member["hostname"] for member in members])
+        for hostname in list(self.member_connections.keys()):
+            if hostname not in current:
+                self.drop_member_connection(hostname)
+
+    def close_quietly(self, conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    # what this member publishes under /members/<name> every cycle
+    def member_status(self, leader_optime=None):
+        status = {"conn_url": self.connection_string, "priority": self.config.get("priority", 1),
+                  "nofailover": bool(self.config.get("nofailover", False))}
+        if not self.is_running():
+            return status
+        try:
+            node = self.node_status()
+        except psycopg2.Error:
+            return status
+
+        status.update(role=node["in_recovery"] and "replica" or "master", timeline=node["timeline"],
+                      receive_location=node["receive_location"], replay_location=node["replay_location"], lag=None)
+        if not node["in_recovery"]:
+            status["lag"] = 0
+        elif leader_optime is not None and node["replay_location"] is not None:
+            status["lag"] = max(0, leader_optime - node["replay_location"])
+        return status
+
     def replication_slot_name(self):
         member = os.environ.get("MEMBER")
         (member, _) = re.subn(r'[^a-z0-9]+', r'_', member)
@@ -177,53 +486,415 @@ class Postgresql:
                 {"username": self.replication["username"], "network": self.replication["network"]})
         f.close()
 
-    def write_recovery_conf(self, leader_hash):
-        f = open("%s/recovery.conf" % self.data_dir, "w")
-        f.write("""
-standby_mode = 'on'
-primary_slot_name = '%(recovery_slot)s'
-recovery_target_timeline = 'latest'
-""" % {"recovery_slot": self.name})
+    def server_version(self):
+        f = open("%s/PG_VERSION" % self.data_dir)
+        major = f.read().strip().split(".")
+        f.close()
+        if int(major[0]) >= 10:
+            return int(major[0]) * 10000
+        return int(major[0]) * 10000 + int(major[1]) * 100
+
+    def recovery_settings(self, leader_hash):
+        settings = {"primary_slot_name": self.name, "recovery_target_timeline": "latest"}
+        if self.server_version() < 120000:
+            settings["standby_mode"] = "on"
         if leader_hash is not None:
             leader = urlparse(leader_hash["address"])
-            f.write("""
-primary_conninfo = 'user=%(user)s password=%(password)s host=%(hostname)s port=%(port)s sslmode=require sslcompression=1'
-            """ % {"user": leader.username, "password": leader.password, "hostname": leader.hostname, "port": leader.port})
-
+            settings["primary_conninfo"] = "user=%(user)s password=%(password)s host=%(hostname)s port=%(port)s sslmode=require sslcompression=1 application_name=%(name)s" % \
+                {"user": leader.username, "password": leader.password, "hostname": leader.hostname, "port": leader.port, "name": self.name}
         if "recovery_conf" in self.config:
-            for name, value in self.config["recovery_conf"].iteritems():
-                f.write("%s = '%s'\n" % (name, value))
+            settings.update(self.config["recovery_conf"])
+        return settings
+
+    def managed_recovery_settings(self):
+        managed = set(RECOVERY_SETTINGS) | set(self.config.get("recovery_conf", {}).keys())
+        if self.server_version() >= 120000:
+            managed.discard("standby_mode")
+        return managed
+
+    # before 12 recovery settings live in recovery.conf; from 12 on they are GUCs kept in
+    # postgresql.auto.conf and standby.signal marks the node as a standby
+    def write_recovery_conf(self, leader_hash):
+        settings = self.recovery_settings(leader_hash)
+        if self.server_version() < 120000:
+            f = open("%s/recovery.conf" % self.data_dir, "w")
+            for name, value in sorted(settings.items()):
+                f.write("%s = '%s'\n" % (name, str(value).replace("'", "''")))
+            f.close()
+            return
+
+        current = self.read_recovery_conf() or {}
+        open("%s/standby.signal" % self.data_dir, "w").close()
+        removed = self.managed_recovery_settings() - set(settings.keys())
+        if self.is_running():
+            for name, value in settings.items():
+                if current.get(name) != str(value):
+                    self.query("ALTER SYSTEM SET %s = %%s;" % name, (str(value),))
+            for name in removed & set(current.keys()):
+                self.query("ALTER SYSTEM RESET %s;" % name)
+        else:
+            self.write_auto_conf(settings, removed)
+
+    def write_auto_conf(self, settings, removed):
+        path = "%s/postgresql.auto.conf" % self.data_dir
+        lines = []
+        if os.path.exists(path):
+            f = open(path)
+            for line in f:
+                match = re.match(r"\s*(\w+)\s*=", line)
+                if not match or (match.group(1) not in settings and match.group(1) not in removed):
+                    lines.append(line)
+            f.close()
+        for name, value in sorted(settings.items()):
+            lines.append("%s = '%s'\n" % (name, str(value).replace("'", "''")))
+        f = open(path, "w")
+        f.write("".join(lines))
         f.close()
 
-    def follow_the_leader(self, leader_hash):
-        leader = urlparse(leader_hash["address"])
-        if os.system("grep 'host=%(hostname)s port=%(port)s' %(data_dir)s/recovery.conf > /dev/null" % {"hostname": leader.hostname, "port": leader.port, "data_dir": self.data_dir}) != 0:
-            self.write_recovery_conf(leader_hash)
+    # settings as a dict, parsed again only when the file's mtime changes
+    def read_conf_file(self, path):
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            self.conf_file_cache.pop(path, None)
+            return None
+
+        cached = self.conf_file_cache.get(path)
+        if cached is None or cached[0] != mtime:
+            settings = {}
+            f = open(path)
+            for line in f:
+                match = re.match(r"\s*(\w+)\s*=\s*'((?:[^']|'')*)'", line) or re.match(r"\s*(\w+)\s*=\s*([^\s#]+)", line)
+                if match:
+                    settings[match.group(1)] = match.group(2).replace("''", "'")
+            f.close()
+            cached = (mtime, settings)
+            self.conf_file_cache[path] = cached
+
+        return cached[1]
+
+    def read_recovery_conf(self):
+        if self.server_version() < 120000:
+            return self.read_conf_file("%s/recovery.conf" % self.data_dir)
+
+        if not os.path.exists("%s/standby.signal" % self.data_dir):
+            return None
+        settings = self.read_conf_file("%s/postgresql.auto.conf" % self.data_dir) or {}
+        managed = self.managed_recovery_settings()
+        return dict([(name, value) for name, value in settings.items() if name in managed])
+
+    def recovery_conf_changes(self, leader_hash):
+        current = self.read_recovery_conf()
+        wanted = dict([(name, str(value)) for name, value in self.recovery_settings(leader_hash).items()])
+        if current is None:
+            return set(wanted.keys())
+        return set([name for name in set(current.keys()) | set(wanted.keys()) if current.get(name) != wanted.get(name)])
+
+    def restart_required(self, changes):
+        version = self.server_version()
+        # recovery.conf is only read at startup
+        if version < 120000:
+            return True
+        return any([version < RELOADABLE_RECOVERY_SETTINGS.get(name, sys.maxint) for name in changes])
+
+    # rewrite the recovery settings only if they differ, then apply them as cheaply as the server allows
+    def apply_recovery_conf(self, leader_hash):
+        changes = self.recovery_conf_changes(leader_hash)
+        if not changes:
+            return
+        self.write_recovery_conf(leader_hash)
+        if not self.is_running():
+            return
+        if self.restart_required(changes):
+            logger.info("Restarting to apply %s" % ", ".join(sorted(changes)))
             self.restart()
+        else:
+            logger.info("Reloading to apply %s" % ", ".join(sorted(changes)))
+            self.reload()
+            self.reset_status()
+
+    def follow_the_leader(self, leader_hash):
+        if leader_hash is not None and self.rewind_required(leader_hash):
+            return self.rejoin(leader_hash)
+        self.apply_recovery_conf(leader_hash)
+        if leader_hash is not None:
+            self.save_state(leader_hash)
         return True
 
     def follow_no_leader(self):
-        if not os.path.exists("%s/recovery.conf" % self.data_dir) or os.system("grep primary_conninfo %(data_dir)s/recovery.conf &> /dev/null" % {"data_dir": self.data_dir}) == 0:
-            self.write_recovery_conf(None)
-            if self.is_running():
-                self.restart()
+        self.apply_recovery_conf(None)
         return True
 
+    @timed(POSTGRES_OPERATION_DURATION, operation="promote")
     def promote(self):
-        return os.system("pg_ctl promote -w -D %s" % self.data_dir) == 0
-
+        PROMOTIONS.inc()
+        self.slot_members = None
+        self.synchronous_standbys = None
+        self.reset_status()
+        # what pg_ctl promote does: leave a trigger file and poke the startup process
+        open("%s/promote" % self.data_dir, "w").close()
+        return self.signal(signal.SIGUSR1)
+
+    @timed(POSTGRES_OPERATION_DURATION, operation="demote")
     def demote(self, leader):
+        DEMOTIONS.inc()
+        self.slot_members = None
+        self.synchronous_standbys = None
+        if leader is not None and self.rewind_required(leader):
+            self.rejoin(leader)
+            return
         self.write_recovery_conf(leader)
+        if leader is not None:
+            self.save_state(leader)
         self.restart()
 
+    # the leader this node last followed or was, so that a restart can start Postgres already
+    # following it instead of waiting for etcd first, and the timeline it last ran as primary on
+    def load_state(self):
+        try:
+            f = open(self.state_file)
+            self.state = json.load(f)
+            f.close()
+        except (IOError, ValueError):
+            return None
+        return self.state
+
+    def save_state(self, leader_hash, timeline=None):
+        # kept until this node has moved past it, see rewind_required
+        state = self.state or self.load_state() or {}
+        if timeline is None:
+            timeline = state.get("timeline")
+        self.write_state(dict(state, leader={"hostname": leader_hash["hostname"], "address": leader_hash["address"]}, timeline=timeline))
+
+    def forget_primary_timeline(self):
+        if self.state is not None and self.state.get("timeline") is not None:
+            self.write_state(dict(self.state, timeline=None))
+
+    def write_state(self, state):
+        if state == self.state:
+            return
+        try:
+            f = open(self.state_file + ".tmp", "w")
+            json.dump(state, f)
+            f.close()
+            os.rename(self.state_file + ".tmp", self.state_file)
+            self.state = state
+        except (IOError, OSError) as e:
+            logger.warning("Could not save state to %s: %s" % (self.state_file, e))
+
+    # An old leader may have written WAL on its timeline past the point where the new leader
+    # branched off, and then cannot stream from it. That is possible while this node last ran as
+    # primary on an older timeline than the leader's and has not moved past it since.
+    def rewind_required(self, leader_hash):
+        if not self.config.get("use_pg_rewind", True):
+            return False
+        state = self.state or self.load_state()
+        primary_timeline = state and state.get("timeline")
+        leader_timeline = leader_hash.get("timeline")
+        if primary_timeline is None or leader_timeline is None or primary_timeline >= leader_timeline:
+            return False
+
+        timeline = self.local_timeline()
+        if timeline is None:
+            return False
+        if timeline > primary_timeline:
+            # it followed a promotion since, so its history is the leader's
+            self.forget_primary_timeline()
+            return False
+        return timeline < leader_timeline
+
+    def local_timeline(self):
+        try:
+            # before 9.6 a running standby only has its last restartpoint's timeline to go by
+            if self.is_running() and self.node_status()["timeline"] is not None:
+                return self.node_status()["timeline"]
+            return int(self.controldata()["Latest checkpoint's TimeLineID"])
+        except (psycopg2.Error, KeyError, ValueError) as e:
+            logger.warning("Could not read the local timeline: %s" % e)
+            return None
+
+    def controldata(self):
+        env = dict(os.environ, LANG="C", LC_ALL="C")
+        output = subprocess.Popen([self.binary("pg_controldata"), self.data_dir], stdout=subprocess.PIPE, env=env).communicate()[0]
+        return dict([line.split(":", 1)[0].strip(), line.split(":", 1)[1].strip()] for line in output.splitlines() if ":" in line)
+
+    # after a clean shutdown this is the shutdown checkpoint, the last record a standby has to replay
+    def checkpoint_location(self):
+        return parse_lsn(self.controldata()["Latest checkpoint location"])
+
+    # poll the member until it has replayed up to location, or the timeout passes
+    def wait_for_replay(self, member, location, timeout):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            conn = None
+            try:
+                conn = self.member_connection(member)
+                cursor = conn.cursor()
+                cursor.execute(wal_names("SELECT pg_last_xlog_replay_location() - '0/0'::pg_lsn;", conn.server_version))
+                replayed = cursor.fetchone()[0]
+                cursor.close()
+                if replayed is not None and replayed >= location:
+                    return True
+                logger.info("Waiting for %s to replay up to %s, at %s" % (member["hostname"], location, replayed))
+            except psycopg2.Error as e:
+                logger.warning("Could not read replay location of %s: %s" % (member["hostname"], e))
+                self.drop_member_connection(member["hostname"])
+            time.sleep(0.2)
+        return False
+
+    # rewind onto the leader's timeline, or clone it afresh when that fails
+    def rejoin(self, leader_hash):
+        logger.info("Timeline of %s has diverged from %s, rewinding" % (self.name, leader_hash["hostname"]))
+        # pg_rewind needs a target that was shut down cleanly
+        if (not self.is_running() or self.stop()) and self.rewind(leader_hash):
+            REWINDS.inc(result="rewound")
+        else:
+            if self.is_running():
+                logger.error("Cannot rejoin %s while PostgreSQL is still running" % leader_hash["hostname"])
+                return False
+            logger.warning("pg_rewind failed, cloning %s from %s" % (self.name, leader_hash["hostname"]))
+            REWINDS.inc(result="cloned")
+            if not self.sync_from_leader(leader_hash):
+                return False
+        self.save_state(leader_hash)
+        self.forget_primary_timeline()
+        self.write_recovery_conf(leader_hash)
+        return self.start()
+
+    @timed(POSTGRES_OPERATION_DURATION, operation="rewind")
+    def rewind(self, leader_hash):
+        leader = urlparse(leader_hash["address"])
+        rewind = self.config.get("rewind", {})
+        # the password goes through the environment, not the command line
+        env = dict(os.environ, PGPASSWORD=rewind.get("password", leader.password))
+        source = "user=%s host=%s port=%s dbname=postgres" % (rewind.get("username", leader.username), leader.hostname, leader.port)
+        command = [self.binary("pg_rewind"), "-D", self.data_dir, "--source-server=%s" % source]
+        logger.info("Running %s" % " ".join(command))
+        return subprocess.call(command, env=env) == 0
+
+    # make pg_replication_slots match the member list in one read and at most one batched write.
+    # Only slots governor created, which the state file lists, are ever dropped, and only once they
+    # have been inactive without a member for orphaned_slot_grace seconds, so that a member whose
+    # key expired while it restarted keeps its slot. Slots made by anything else are left alone.
+    def sync_replication_slots(self, members):
+        wanted = set([member["hostname"] for member in members if member["hostname"] != self.name])
+        if wanted == self.slot_members and not self.orphaned_slots:
+            return
+
+        existing = {}
+        for slot_name, active, retained in self.query("SELECT slot_name, active, pg_current_xlog_location() - restart_lsn FROM pg_replication_slots WHERE slot_type = 'physical';").fetchall():
+            existing[slot_name] = (active, retained or 0)
+
+        state = self.state or self.load_state() or {}
+        # a slot named after a member is governor's, including the ones made before slots were listed
+        owned = (set(state.get("slots", [])) | wanted) & set(existing.keys())
+        create = sorted(wanted - set(existing.keys()))
+        orphans = sorted(set(existing.keys()) - wanted)
+
+        now = time.time()
+        drop = []
+        orphaned, self.orphaned_slots = self.orphaned_slots, {}
+        for slot in orphans:
+            active, retained = existing[slot]
+            if slot not in orphaned:
+                logger.warning("Replication slot %s has no member in etcd and retains %s bytes of WAL" % (slot, retained))
+            if active:
+                self.orphaned_since.pop(slot, None)
+            elif slot in owned and now - self.orphaned_since.setdefault(slot, now) >= self.orphaned_slot_grace:
+                drop.append(slot)
+                continue
+            self.orphaned_slots[slot] = retained
+        self.orphaned_since = dict([(slot, since) for slot, since in self.orphaned_since.items() if slot in self.orphaned_slots])
+
+        statements = []
+        if create:
+            statements.append("SELECT pg_create_physical_replication_slot(name) FROM unnest(%(create)s::text[]) AS name;")
+        if drop:
+            statements.append("SELECT pg_drop_replication_slot(name) FROM unnest(%(drop)s::text[]) AS name;")
+        if statements:
+            logger.info("Creating replication slots %s, dropping %s" % (create, drop))
+            try:
+                self.query(" ".join(statements), {"create": create, "drop": drop})
+            except psycopg2.Error:
+                self.slot_members = None
+                raise
+
+        self.write_state(dict(state, slots=sorted((owned | set(create)) - set(drop))))
+        self.slot_members = wanted
+
+    # (member name, sync_state, bytes behind) for every streaming standby, closest first
+    def streaming_standbys(self):
+        return self.query("""SELECT application_name, sync_state, pg_current_xlog_location() - replay_location
+            FROM pg_stat_replication WHERE state = 'streaming' ORDER BY 3, 1;""").fetchall()
+
+    def get_synchronous_standbys(self):
+        if self.synchronous_standbys is None:
+            value = self.query("SHOW synchronous_standby_names;").fetchone()[0]
+            self.synchronous_standbys = parse_synchronous_standby_names(value)
+        return self.synchronous_standbys
+
+    # applied with ALTER SYSTEM and a reload, never a restart
+    def set_synchronous_standbys(self, names):
+        value = format_synchronous_standby_names(names)
+        logger.info("Setting synchronous_standby_names to '%s'" % value)
+        self.query("ALTER SYSTEM SET synchronous_standby_names = %s;", (value,))
+        self.reload()
+        self.synchronous_standbys = list(names)
+
+    # bytes each connected standby has yet to replay, keyed by its member name
+    def replication_lag(self):
+        return dict(self.query("SELECT application_name, pg_current_xlog_location() - replay_location FROM pg_stat_replication;").fetchall())
+
     def create_replication_user(self):
         self.query("CREATE USER \"%s\" WITH REPLICATION ENCRYPTED PASSWORD '%s';" % (self.replication["username"], self.replication["password"]))
 
     def xlog_position(self):
-        return self.query("SELECT pg_last_xlog_replay_location() - '0/0000000'::pg_lsn;").fetchone()[0]
+        return self.node_status()["replay_location"]
 
     def last_operation(self):
         if self.is_leader():
-            return self.query("SELECT pg_current_xlog_location() - '0/00000'::pg_lsn;").fetchone()[0]
+            return self.node_status()["current_location"]
         else:
             return self.xlog_position()
+
+# PostgreSQL 10 renamed xlog to wal and location to lsn in function and column names; queries
+# here use the old names and are translated for newer servers
+WAL_NAMES = [
+    ("pg_current_xlog_location", "pg_current_wal_lsn"),
+    ("pg_last_xlog_receive_location", "pg_last_wal_receive_lsn"),
+    ("pg_last_xlog_replay_location", "pg_last_wal_replay_lsn"),
+    ("pg_xlogfile_name", "pg_walfile_name"),
+    ("replay_location", "replay_lsn"),
+]
+
+def wal_names(sql, server_version):
+    if server_version < 100000:
+        return sql
+    for old, new in WAL_NAMES:
+        sql = re.sub(r"\b%s\b" % old, new, sql)
+    return sql
+
+# candidates compare by timeline first, then by how much WAL they have, received or replayed,
+# since a promotion replays everything received; priority breaks ties
+def election_rank(status):
+    location = max(status.get("receive_location") or 0, status.get("replay_location") or 0)
+    return (status.get("timeline") or 0, location, status.get("priority", 1))
+
+def format_synchronous_standby_names(names):
+    quoted = ['"%s"' % name.replace('"', '""') for name in names]
+    if len(quoted) < 2:
+        return "".join(quoted)
+    return "%d (%s)" % (len(quoted), ",".join(quoted))
+
+def parse_synchronous_standby_names(value):
+    names = []
+    for quoted, bare in re.findall(r'"((?:[^"]|"")*)"|([^\s,()"]+)', value):
+        if quoted:
+            names.append(quoted.replace('""', '"'))
+        elif not bare.isdigit() and bare.upper() not in ("FIRST", "ANY"):
+            names.append(bare)
+    return names
+
+def parse_lsn(lsn):
+    high, low = lsn.split("/")
+    return (int(high, 16) << 32) + int(low, 16)
@@ -0,0 +1,87 @@
+import threading, time
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Runs the HA cycles of many clusters on one pool of worker threads. A job never runs twice at
+# once; it is due again the number of seconds its cycle returned after it ends, or as soon as it
+# is woken. A job that fails or hangs only holds up its own worker.
+class Scheduler:
+    def __init__(self, workers):
+        self.workers = workers
+        self.jobs = {}
+        self.due = {}
+        self.running = set()
+        self.woken = set()
+        self.condition = threading.Condition()
+
+    def add(self, name, cycle, fallback_delay):
+        with self.condition:
+            self.jobs[name] = (cycle, fallback_delay)
+            self.due[name] = time.time()
+            self.condition.notify()
+
+    # a wakeup object for a job that is added later, e.g. once its cluster has bootstrapped
+    def wakeup(self, name):
+        return Wakeup(self, name)
+
+    def wake(self, name):
+        with self.condition:
+            if name in self.running:
+                self.woken.add(name)
+            elif name in self.due:
+                self.due[name] = min(self.due[name], time.time())
+                self.condition.notify()
+
+    def next(self):
+        with self.condition:
+            while True:
+                now = time.time()
+                waiting = [(due, name) for name, due in self.due.items() if name not in self.running]
+                if waiting:
+                    due, name = min(waiting)
+                    if due <= now:
+                        self.running.add(name)
+                        self.woken.discard(name)
+                        return name
+                    self.condition.wait(due - now)
+                else:
+                    self.condition.wait()
+
+    def done(self, name, delay):
+        with self.condition:
+            self.running.discard(name)
+            if name in self.woken:
+                self.woken.discard(name)
+                delay = 0
+            self.due[name] = time.time() + delay
+            self.condition.notify()
+
+    def work(self):
+        while True:
+            name = self.next()
+            cycle, fallback_delay = self.jobs[name]
+            delay = fallback_delay
+            # log lines from this cycle carry the cluster's name
+            threading.current_thread().name = name
+            try:
+                delay = cycle()
+            except Exception:
+                logger.exception("HA cycle of %s failed" % name)
+            finally:
+                self.done(name, delay)
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self.work, name="scheduler %s" % i)
+            thread.daemon = True
+            thread.start()
+
+# what LeaderHeartbeat and the watchers call set() on to wake the loop early
+class Wakeup:
+    def __init__(self, scheduler, name):
+        self.scheduler = scheduler
+        self.name = name
+
+    def set(self):
+        self.scheduler.wake(self.name)
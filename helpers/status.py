@@ -0,0 +1,168 @@
+import threading, time, socket, ssl, urllib2
+import logging, psycopg2
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from urlparse import urlparse, parse_qs
+from helpers.etcd import etcd_client
+from helpers.postgresql import Postgresql
+from helpers.metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+class StatusCache(threading.Thread):
+    def __init__(self, etcd, refresh_interval):
+        threading.Thread.__init__(self, name="status cache")
+        self.daemon = True
+        self.etcd = etcd
+        self.refresh_interval = refresh_interval
+        self.leader = None
+        self.leader_optime = None
+        self.updated_at = None
+
+    # re-read the cluster whenever the leader key changes, and at least every refresh_interval
+    def run(self):
+        while True:
+            try:
+                snapshot = self.etcd.fetch_snapshot()
+                optime = snapshot.get("/optime/leader")
+                self.leader = snapshot.leader()
+                self.leader_optime = int(optime["value"]) if optime is not None else None
+                self.updated_at = time.time()
+                self.etcd.watch("/leader", snapshot.index + 1, self.refresh_interval)
+            except (socket.timeout, ssl.SSLError):
+                continue
+            except urllib2.URLError as e:
+                if isinstance(e.reason, socket.timeout):
+                    continue
+                logger.warning("Could not refresh leader from etcd: %s" % e)
+                time.sleep(1)
+            except Exception as e:
+                logger.error("Could not refresh leader from etcd: %s" % e)
+                time.sleep(1)
+
+    def age(self):
+        if self.updated_at is None:
+            return None
+        return time.time() - self.updated_at
+
+class NodeStatusCache(threading.Thread):
+    def __init__(self, postgresql, refresh_interval):
+        threading.Thread.__init__(self, name="node status cache")
+        self.daemon = True
+        self.postgresql = postgresql
+        self.refresh_interval = refresh_interval
+        self.status = None
+        self.updated_at = None
+
+    def run(self):
+        while True:
+            try:
+                self.postgresql.reset_status()
+                if self.postgresql.is_running():
+                    self.status = self.postgresql.node_status()
+                else:
+                    self.status = None
+            except psycopg2.Error as e:
+                logger.warning("Could not read local node status: %s" % e)
+                self.postgresql.drop_connection()
+                self.status = None
+            self.updated_at = time.time()
+            time.sleep(self.refresh_interval)
+
+    def age(self):
+        if self.updated_at is None:
+            return None
+        return time.time() - self.updated_at
+
+class StatusHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        return self.do_ANY()
+    def do_OPTIONS(self):
+        return self.do_ANY()
+    def do_ANY(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        if url.path in ("/", "/master"):
+            healthy = self.server.is_leader()
+        elif url.path == "/replica":
+            try:
+                max_lag = int(query["max_lag"][0]) if "max_lag" in query else None
+            except ValueError:
+                max_lag = None
+            healthy = self.server.is_replica(max_lag)
+        elif url.path == "/health":
+            healthy = self.server.is_running()
+        elif url.path == "/metrics":
+            body = REGISTRY.render()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        else:
+            self.send_response(404)
+            self.end_headers()
+            return
+
+        if healthy:
+          self.send_response(200)
+        else:
+          self.send_response(503)
+        self.end_headers()
+        self.wfile.write('\r\n')
+        return
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+class StatusServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, listen, postgresql, cache, node_cache, max_staleness):
+        host, port = listen.split(":")
+        HTTPServer.__init__(self, (host, int(port)), StatusHandler)
+        self.postgresql = postgresql
+        self.cache = cache
+        self.node_cache = node_cache
+        self.max_staleness = max_staleness
+
+    # an answer older than max_staleness is not trusted, so HAProxy takes the node out
+    def is_fresh(self, cache):
+        age = cache.age()
+        return age is not None and age <= self.max_staleness
+
+    def is_leader(self):
+        if not self.is_fresh(self.cache):
+            return False
+        return self.cache.leader == self.postgresql.name
+
+    def is_running(self):
+        return self.is_fresh(self.node_cache) and self.node_cache.status is not None
+
+    def is_replica(self, max_lag=None):
+        status = self.node_cache.status
+        if not self.is_running() or status is None or not status["in_recovery"]:
+            return False
+        if max_lag is None:
+            return True
+        if not self.is_fresh(self.cache):
+            return False
+        lag = self.lag(status)
+        return lag is not None and lag <= max_lag
+
+    # how far local replay is behind the optime the leader last published
+    def lag(self, status):
+        if self.cache.leader_optime is None or status["replay_location"] is None:
+            return None
+        return max(0, self.cache.leader_optime - status["replay_location"])
+
+def status_server(config):
+    refresh_interval = config["haproxy_status"].get("refresh_interval", 5)
+    cache = StatusCache(etcd_client(config["etcd"]), refresh_interval)
+    cache.start()
+    postgresql = Postgresql(config["postgresql"])
+    node_cache = NodeStatusCache(postgresql, min(refresh_interval, 1))
+    node_cache.start()
+    return StatusServer(config["haproxy_status"]["listen"], postgresql, cache, node_cache,
+                        config["haproxy_status"].get("max_staleness", config["etcd"]["ttl"]))
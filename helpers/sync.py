@@ -0,0 +1,35 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Run by the leader every cycle. Picks the synchronous standbys from the ones streaming right now,
+# applies them with a reload and records in etcd which standbys are known to have every commit, so
+# that only one of those may be promoted. A standby is recorded only once Postgres reports it as
+# synchronous, and one that is being dropped is taken out of the record before Postgres stops
+# waiting for it.
+class SynchronousReplication:
+    def __init__(self, postgresql, etcd, count=1):
+        self.postgresql = postgresql
+        self.etcd = etcd
+        self.count = count
+
+    def update(self, members):
+        candidates = set([member["hostname"] for member in members if not member.get("nofailover")])
+        candidates.discard(self.postgresql.name)
+
+        streaming = [row for row in self.postgresql.streaming_standbys() if row[0] in candidates]
+        current = self.postgresql.get_synchronous_standbys()
+        picked = self.pick(streaming, current)
+        synced = [name for name, sync_state, lag in streaming if sync_state in ("sync", "quorum") and name in current]
+
+        self.etcd.set_sync_state(self.postgresql.name, sorted(set(synced) & set(picked)))
+        if picked != current:
+            logger.info("Synchronous standbys %s, were %s" % (picked, current))
+            self.postgresql.set_synchronous_standbys(picked)
+
+    # keep the current synchronous standbys while they stream, fill up with the closest others;
+    # with none streaming, commits stop waiting rather than stall
+    def pick(self, streaming, current):
+        names = [name for name, sync_state, lag in streaming]
+        keep = [name for name in current if name in names]
+        return (keep + [name for name in names if name not in keep])[:self.count]
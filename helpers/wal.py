@@ -0,0 +1,191 @@
+import os, re, gzip, shutil, fcntl, errno, threading, Queue
+import logging
+
+logger = logging.getLogger(__name__)
+
+SEGMENT = re.compile(r"^[0-9A-F]{24}$")
+
+# A directory of gzip-compressed WAL files. Files appear under their final name only once they
+# are complete and on disk, so one that exists can be trusted.
+class Archive:
+    def __init__(self, directory, compress_level=1):
+        self.directory = directory
+        self.compress_level = compress_level
+
+    def path(self, name):
+        return os.path.join(self.directory, name + ".gz")
+
+    def contains(self, name):
+        return os.path.exists(self.path(name))
+
+    def push(self, source, name):
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        tmp = "%s.%s.tmp" % (self.path(name), threading.current_thread().ident)
+        with open(source, "rb") as f:
+            out = open(tmp, "wb")
+            try:
+                compressed = gzip.GzipFile(name, "wb", self.compress_level, out)
+                copy(f, compressed)
+                compressed.close()
+                out.flush()
+                os.fsync(out.fileno())
+            finally:
+                out.close()
+        os.rename(tmp, self.path(name))
+        fsync_directory(self.directory)
+
+    # False when the archive does not have it (yet)
+    def fetch(self, name, target):
+        try:
+            compressed = gzip.open(self.path(name), "rb")
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return False
+            raise
+        tmp = "%s.%s.tmp" % (target, threading.current_thread().ident)
+        try:
+            with open(tmp, "wb") as out:
+                copy(compressed, out)
+        except Exception:
+            remove_quietly(tmp)
+            raise
+        finally:
+            compressed.close()
+        os.rename(tmp, target)
+        return True
+
+# archive_command: archive the segment Postgres asks for together with the next ones it has
+# marked ready, compressing on several threads. Those then answer at once when their turn comes.
+def archive_wal(archive, wal_path, workers):
+    name = os.path.basename(wal_path)
+    if archive.contains(name):
+        logger.info("%s was already archived" % name)
+        return True
+
+    status = os.path.join(os.path.dirname(wal_path), "archive_status")
+    ahead = []
+    if SEGMENT.match(name) and workers > 1:
+        try:
+            ready = sorted([f[:-len(".ready")] for f in os.listdir(status) if f.endswith(".ready")])
+        except OSError:
+            ready = []
+        ahead = [f for f in ready if f > name and SEGMENT.match(f) and not archive.contains(f)][:workers - 1]
+
+    sources = [(name, wal_path)] + [(f, os.path.join(os.path.dirname(wal_path), f)) for f in ahead]
+    results = parallel(sources, lambda (segment, source): archive.push(source, segment), workers)
+    for segment, error in results.items():
+        if error is not None:
+            logger.error("Could not archive %s: %s" % (segment[0], error))
+    return results[(name, wal_path)] is None
+
+# restore_command: hand over the file from the spool when it was prefetched, from the archive
+# otherwise, and keep the next segments coming into the spool in the background
+def restore_wal(archive, spool, name, target, prefetch, segment_size, workers):
+    spooled = os.path.join(spool, name)
+    if os.path.exists(spooled):
+        shutil.move(spooled, target)
+        restored = True
+    else:
+        restored = archive.fetch(name, target)
+
+    if restored and SEGMENT.match(name) and prefetch > 0:
+        start_prefetch(archive, spool, name, prefetch, segment_size, workers)
+    return restored
+
+# detached from Postgres, which waits for restore_command to exit; one prefetcher per spool at a time
+def start_prefetch(archive, spool, name, count, segment_size, workers):
+    pid = os.fork()
+    if pid > 0:
+        os.waitpid(pid, 0)
+        return
+    try:
+        os.setsid()
+        if os.fork() > 0:
+            os._exit(0)
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for fd in (0, 1, 2):
+            os.dup2(devnull, fd)
+        prefetch(archive, spool, name, count, segment_size, workers)
+    except Exception:
+        pass
+    os._exit(0)
+
+def prefetch(archive, spool, name, count, segment_size, workers):
+    if not os.path.isdir(spool):
+        os.makedirs(spool)
+    lock = open(os.path.join(spool, ".prefetch.lock"), "w")
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError:
+        return
+
+    # what replay has gone past will not be asked for again
+    for f in os.listdir(spool):
+        if f.endswith(".tmp") or (SEGMENT.match(f) and f <= name):
+            remove_quietly(os.path.join(spool, f))
+
+    segments = []
+    for i in range(count):
+        name = next_segment(name, segment_size)
+        if not os.path.exists(os.path.join(spool, name)):
+            segments.append(name)
+    parallel(segments, lambda segment: archive.fetch(segment, os.path.join(spool, segment)), workers)
+    lock.close()
+
+# runs job on every item on up to workers threads; maps each item to the exception it raised, or None
+def parallel(items, job, workers):
+    queue = Queue.Queue()
+    for item in items:
+        queue.put(item)
+    results = {}
+
+    def work():
+        while True:
+            try:
+                item = queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                job(item)
+                results[item] = None
+            except Exception as e:
+                results[item] = e
+
+    threads = [threading.Thread(target=work) for i in range(max(1, min(workers, len(items))))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+# the segment after name: timeline, then the log and segment numbers, with 4GB of WAL per log number
+def next_segment(name, segment_size):
+    timeline, log, segment = int(name[:8], 16), int(name[8:16], 16), int(name[16:], 16) + 1
+    if segment >= 0x100000000 / segment_size:
+        log, segment = log + 1, 0
+    return "%08X%08X%08X" % (timeline, log, segment)
+
+def copy(source, target):
+    while True:
+        data = source.read(1024 * 1024)
+        if not data:
+            return
+        target.write(data)
+
+def fsync_directory(directory):
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def remove_quietly(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
@@ -0,0 +1,110 @@
+import threading, time, signal, psycopg2
+import logging
+from helpers.metrics import FENCES
+
+logger = logging.getLogger(__name__)
+
+# Fences the local primary once the leader lease is about to run out without a renewal, whatever
+# the HA loop is stuck on, so that a shorter ttl cannot leave two writable primaries. Uses its own
+# connection and signals, never the HA loop's.
+class LeaseWatchdog(threading.Thread):
+    def __init__(self, heartbeat, postgresql, mode="stop", safety_margin=5, haproxy=None):
+        threading.Thread.__init__(self, name="lease watchdog")
+        self.daemon = True
+        self.heartbeat = heartbeat
+        self.postgresql = postgresql
+        self.haproxy = haproxy
+        self.mode = mode
+        # the heartbeat renews every third of the ttl; a wider margin would fence between renewals
+        self.safety_margin = min(safety_margin, heartbeat.etcd.ttl / 3.0)
+        self.interval = max(0.2, min(1, self.safety_margin / 4.0))
+        self.fenced_at = None
+
+    def run(self):
+        while True:
+            try:
+                self.check()
+            except Exception as e:
+                logger.error("Lease watchdog failed: %s" % e)
+            time.sleep(self.interval)
+
+    def check(self):
+        if self.fenced_at is not None:
+            # read-only lasts until the lock is written again
+            renewed_at = self.heartbeat.renewed_at
+            if renewed_at is not None and renewed_at > self.fenced_at:
+                self.unfence()
+            return
+        expires = self.heartbeat.lease_expires()
+        if expires is None or time.time() < expires - self.safety_margin:
+            return
+
+        if not self.postgresql.is_running() or self.is_primary() is False:
+            # nothing left to fence; this lease is done with
+            self.heartbeat.expire()
+            return
+        logger.error("Leader lease expires in %.1fs without a renewal, fencing Postgres (%s)" % (expires - time.time(), self.mode))
+        FENCES.inc(mode=self.mode)
+        if self.haproxy is not None:
+            self.haproxy.demoted()
+        if self.mode == "read_only":
+            self.make_read_only()
+            self.fenced_at = time.time()
+        else:
+            self.stop()
+            self.heartbeat.expire()
+
+    # None when Postgres does not answer, which is treated as still primary
+    def is_primary(self):
+        conn = None
+        try:
+            conn = self.connect()
+            cursor = conn.cursor()
+            cursor.execute("SELECT NOT pg_is_in_recovery();")
+            return cursor.fetchone()[0]
+        except psycopg2.Error:
+            return None
+        finally:
+            if conn is not None:
+                self.postgresql.close_quietly(conn)
+
+    def connect(self):
+        conn = psycopg2.connect(self.postgresql.local_connection_string(), connect_timeout=max(1, int(self.safety_margin / 2)))
+        conn.autocommit = True
+        return conn
+
+    # a fast shutdown, and recovery settings without a primary, so that whatever starts it
+    # next starts a standby; the HA loop promotes it again if the lock is still ours
+    def stop(self):
+        self.postgresql.signal(signal.SIGINT)
+        deadline = time.time() + 60
+        while self.postgresql.is_running() and time.time() < deadline:
+            time.sleep(0.1)
+        if self.postgresql.is_running():
+            logger.error("PostgreSQL is still running after being fenced")
+            return
+        self.postgresql.write_recovery_conf(None)
+
+    # new transactions default to read-only and the open sessions, which may have begun writing, are ended
+    def make_read_only(self):
+        conn = self.connect()
+        try:
+            cursor = conn.cursor()
+            cursor.execute("ALTER SYSTEM SET default_transaction_read_only = on;")
+            cursor.execute("SELECT pg_reload_conf();")
+            cursor.execute("SELECT pg_terminate_backend(pid) FROM pg_stat_activity WHERE pid <> pg_backend_pid() AND datname IS NOT NULL;")
+        finally:
+            self.postgresql.close_quietly(conn)
+
+    def unfence(self):
+        logger.info("Leader lease renewed, lifting read-only fencing")
+        conn = self.connect()
+        try:
+            cursor = conn.cursor()
+            cursor.execute("ALTER SYSTEM RESET default_transaction_read_only;")
+            cursor.execute("SELECT pg_reload_conf();")
+        finally:
+            self.postgresql.close_quietly(conn)
+        self.fenced_at = None
+        if self.haproxy is not None:
+            self.haproxy.promoted()
@@ -0,0 +1,59 @@
+import threading, time, socket, ssl, urllib2
+import logging
+from helpers.etcd import parse_member
+
+logger = logging.getLogger(__name__)
+
+class Watcher(threading.Thread):
+    def __init__(self, etcd, path, wakeup, timeout):
+        threading.Thread.__init__(self, name="watch %s" % path)
+        self.daemon = True
+        self.etcd = etcd
+        self.path = path
+        self.wakeup = wakeup
+        self.timeout = timeout
+        self.index = None
+
+    def run(self):
+        while True:
+            try:
+                if self.index is None:
+                    self.index = self.etcd.fetch_snapshot().index + 1
+                response = self.etcd.watch(self.path, self.index, self.timeout)
+                self.index = response["node"]["modifiedIndex"] + 1
+                if self.changed(response):
+                    logger.info("%s changed (%s), waking up HA loop" % (response["node"]["key"], response["action"]))
+                    self.wakeup.set()
+            except (socket.timeout, ssl.SSLError):
+                continue
+            except urllib2.HTTPError as e:
+                # 400 means our waitIndex fell out of etcd's event history
+                if e.code != 400:
+                    logger.warning("Watch on %s failed: %s" % (self.path, e))
+                    time.sleep(1)
+                self.index = None
+            except urllib2.URLError as e:
+                if isinstance(e.reason, socket.timeout):
+                    continue
+                logger.warning("Watch on %s failed: %s" % (self.path, e))
+                self.index = None
+                time.sleep(1)
+            except Exception as e:
+                logger.error("Watch on %s failed: %s" % (self.path, e))
+                self.index = None
+                time.sleep(1)
+
+    # ttl refreshes rewrite the same value every cycle, and members republish their positions;
+    # only wake on a new leader, or a member joining, leaving or moving
+    def changed(self, response):
+        previous = response.get("prevNode") or {}
+        return self.address(response["node"].get("value")) != self.address(previous.get("value"))
+
+    def address(self, value):
+        if value is None:
+            return None
+        return parse_member(None, value)["address"]
+
+def watch_cluster(etcd, wakeup, timeout):
+    for path in ("/leader", "/members", "/switchover"):
+        Watcher(etcd, path, wakeup, timeout).start()
@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+
+# usage: switchover.py <config.yml> <target member> [timeout seconds]
+#
+# asks the current leader to hand the leader lock to the target and waits until the target holds it
+
+from helpers.etcd import etcd_client
+import sys, yaml, time
+
+f = open(sys.argv[1], "r")
+config = yaml.load(f.read())
+f.close()
+
+target = sys.argv[2]
+timeout = int(sys.argv[3]) if len(sys.argv) > 3 else 60
+
+etcd = etcd_client(config["etcd"])
+cluster = etcd.cluster()
+leader = cluster.leader()
+if leader is None:
+    print "there is no leader to switch over from"
+    sys.exit(1)
+if leader == target:
+    print "%s is already the leader" % target
+    sys.exit(0)
+if target not in [member["hostname"] for member in cluster.members() or []]:
+    print "%s is not a member of %s" % (target, config["etcd"]["scope"])
+    sys.exit(1)
+
+# the request expires on its own if the leader never gets to it
+etcd.request_switchover(leader, target, timeout)
+print "asked %s to switch over to %s" % (leader, target)
+
+deadline = time.time() + timeout
+while time.time() < deadline:
+    time.sleep(1)
+    leader = etcd.fetch_snapshot().leader()
+    if leader == target:
+        print "%s is the leader" % target
+        sys.exit(0)
+    print "leader: %s" % leader
+
+print "%s did not become the leader within %ss" % (target, timeout)
+sys.exit(1)
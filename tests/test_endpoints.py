@@ -0,0 +1,46 @@
+import socket, time, unittest, urllib2
+from helpers.connection_pool import ConnectionPool
+from helpers.endpoints import Endpoints
+from helpers.fake_etcd import FakeEtcd
+
+# a peer that takes connections and never answers, as an etcd node behind a blackholing partition does
+def blackhole():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(("127.0.0.1", 0))
+    sock.listen(8)
+    return sock
+
+class BlackholedEndpointTest(unittest.TestCase):
+    def setUp(self):
+        self.etcd = FakeEtcd()
+        self.etcd.store.set("/service/batman/leader", "postgresql0")
+        self.blackhole = blackhole()
+        urls = ["http://127.0.0.1:%s" % self.blackhole.getsockname()[1], self.etcd.listener("postgresql0").url()]
+        self.endpoints = Endpoints(urls, ConnectionPool(), {}, 0.5)
+        # only the configured peers
+        self.endpoints.discovered_at = time.time()
+        self.blackholed, self.healthy = self.endpoints.endpoints
+
+    def tearDown(self):
+        self.blackhole.close()
+        self.etcd.shutdown()
+
+    def test_recorded_timeout_fails_over(self):
+        headers, response = self.endpoints.request("GET", "/v2/keys/service/batman/leader", timeout=0.5)
+        self.assertIn("postgresql0", response)
+        self.assertIsNotNone(self.blackholed.failed_at)
+        self.assertIsNone(self.healthy.failed_at)
+
+        # the blackholed peer is now ranked last, so the next request does not wait on it
+        self.assertEqual(self.endpoints.ranked()[0], self.healthy)
+        started = time.time()
+        self.endpoints.request("GET", "/v2/keys/service/batman/leader", timeout=0.5)
+        self.assertLess(time.time() - started, 0.5)
+
+    def test_long_poll_timeout_leaves_endpoint_alone(self):
+        self.assertRaises(urllib2.URLError, self.endpoints.request, "GET", "/v2/keys/service/batman/leader?wait=true", timeout=0.5, record=False)
+        self.assertIsNone(self.blackholed.failed_at)
+        self.assertIsNone(self.healthy.failed_at)
+
+if __name__ == "__main__":
+    unittest.main()
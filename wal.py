@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+
+# archive_command: wal.py archive <archive dir> %p
+# restore_command: wal.py restore <archive dir> <spool dir> %f %p
+
+from helpers.wal import Archive, archive_wal, restore_wal
+import sys, argparse, logging
+
+logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s', level=logging.INFO)
+
+parser = argparse.ArgumentParser(description="Archive and restore WAL for Postgres.")
+commands = parser.add_subparsers(dest="command")
+
+archive = commands.add_parser("archive", help="compress the segment and the next ones ready for archiving into the archive")
+archive.add_argument("archive_dir")
+archive.add_argument("wal_path", help="%p")
+archive.add_argument("--workers", type=int, default=4, help="segments compressed at once")
+archive.add_argument("--compress-level", type=int, default=1)
+
+restore = commands.add_parser("restore", help="restore a file from the spool or the archive and prefetch the next segments")
+restore.add_argument("archive_dir")
+restore.add_argument("spool_dir", help="where prefetched segments wait; one per member, outside the data directory")
+restore.add_argument("name", help="%f")
+restore.add_argument("target", help="%p")
+restore.add_argument("--prefetch", type=int, default=8, help="segments to fetch ahead, 0 to turn prefetching off")
+restore.add_argument("--workers", type=int, default=4, help="segments decompressed at once")
+restore.add_argument("--segment-size", type=int, default=16, help="wal_segment_size in megabytes")
+
+options = parser.parse_args()
+if options.command == "archive":
+    ok = archive_wal(Archive(options.archive_dir, options.compress_level), options.wal_path, options.workers)
+else:
+    ok = restore_wal(Archive(options.archive_dir), options.spool_dir, options.name, options.target,
+                     options.prefetch, options.segment_size * 1024 * 1024, options.workers)
+sys.exit(0 if ok else 1)